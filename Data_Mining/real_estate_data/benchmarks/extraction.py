@@ -0,0 +1,135 @@
+"""
+Microbenchmark of the detail page extraction.
+
+Compares the evaluation of every XPath expression with ``ItemLoader.add_xpath`` with
+:class:`~immo_crawl.extraction.XPathExtractor` on the recorded detail page fixtures and
+checks that both produce the same items.
+
+The fast path of :class:`~immo_crawl.extraction.EmbeddedJsonExtractor` is compared with
+:class:`~immo_crawl.extraction.XPathExtractor` as well: for the CPU time per page, for the
+cost of the byte search on pages without JSON state (which fall back to XPath), and for the
+agreement of each field after :class:`~immo_crawl.pipelines.ValidateAndClean`.
+
+Usage (from ``Data_Mining/real_estate_data``)::
+
+    python -m benchmarks.extraction --pages 2000
+"""
+import time
+import argparse
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from benchmarks import server
+from immo_crawl.items import ImmoCrawlItem, HomeGateLoader, ImmoScoutLoader
+from immo_crawl.pipelines import ValidateAndClean
+from immo_crawl.spiders.homegate_spider import HomegateSpider
+from immo_crawl.spiders.immoscout_spider import ImmoscoutSpider
+
+SITES = {
+    'homegate': (HomegateSpider, HomeGateLoader, 'homegate_detail', server.homegate_detail_path),
+    'immoscout': (ImmoscoutSpider, ImmoScoutLoader, 'immoscout_detail', server.immoscout_detail_path),
+}
+
+
+def detail_pages(site, count):
+    """
+    Renders ``count`` detail pages of a site from the fixtures.
+    """
+    template = server.load_fixture(SITES[site][2] + '.html')
+    pages = []
+    for ad_id in range(count):
+        url = 'https://www.{}.ch{}'.format(site, SITES[site][3](ad_id))
+        pages.append((url, template.substitute(server.listing(ad_id)).encode('utf-8')))
+    return pages
+
+
+def add_xpath(loader, extractor, response):
+    for field, expression in extractor.fields.items():
+        loader.add_xpath(field, expression)
+
+
+def extractor_load(loader, extractor, response):
+    extractor.load(loader, response)
+
+
+def run(site, pages, load):
+    """
+    Extracts the items of all pages with ``load`` and returns the items and the CPU time per page.
+    """
+    spider_cls, loader_cls = SITES[site][:2]
+    items = []
+    start = time.process_time()
+    for url, body in pages:
+        response = HtmlResponse(url, body=body, encoding='utf-8', request=Request(url))
+        loader = loader_cls(item=ImmoCrawlItem(), response=response)
+        load(loader, spider_cls.extractor, response)
+        items.append(loader.load_item())
+    return items, (time.process_time() - start) / len(pages)
+
+
+def run_embedded(site, pages):
+    """
+    Extracts the items of all pages from their JSON state and returns the items and the CPU time per page.
+    Pages without state give ``None`` instead of an item.
+    """
+    embedded = SITES[site][0].embedded
+    items = []
+    start = time.process_time()
+    for url, body in pages:
+        response = HtmlResponse(url, body=body, encoding='utf-8', request=Request(url))
+        fields = embedded.extract(response)
+        items.append(ImmoCrawlItem(fields) if fields is not None else None)
+    return items, (time.process_time() - start) / len(pages)
+
+
+def without_state(pages):
+    """
+    Removes the JSON state from the pages, as on a page that is only rendered as HTML.
+    """
+    return [(url, body[:body.find(b'<script>window.__INITIAL_STATE__')]) for url, body in pages]
+
+
+def agreement(site, xpath_items, json_items):
+    """
+    Returns the share of items for each field in which both paths give the same value
+    after :class:`~immo_crawl.pipelines.ValidateAndClean`.
+    """
+    spider_cls = SITES[site][0]
+    spider = spider_cls.from_crawler(get_crawler(spider_cls))
+    pipeline = ValidateAndClean()
+    equal = dict.fromkeys(ImmoCrawlItem.fields, 0)
+    for xpath_item, json_item in zip(xpath_items, json_items):
+        xpath_item = pipeline.process_item(ImmoCrawlItem(xpath_item), spider)
+        json_item = pipeline.process_item(ImmoCrawlItem(json_item), spider)
+        for field in equal:
+            equal[field] += xpath_item.get(field) == json_item.get(field)
+    return {field: count / len(xpath_items) for field, count in equal.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare add_xpath, the precompiled XPathExtractor and the embedded JSON state.')
+    parser.add_argument('--pages', type=int, default=1000, help='detail pages per site')
+    args = parser.parse_args()
+
+    for site in SITES:
+        pages = detail_pages(site, args.pages)
+        baseline_items, baseline = run(site, pages, add_xpath)
+        items, compiled = run(site, pages, extractor_load)
+        assert [dict(item) for item in items] == [dict(item) for item in baseline_items], site
+        print('{}: add_xpath {:.1f} µs/page, XPathExtractor {:.1f} µs/page ({:.0%} less CPU)'.format(
+            site, baseline * 1e6, compiled * 1e6, 1 - compiled / baseline))
+
+        json_items, embedded = run_embedded(site, pages)
+        assert None not in json_items, site
+        _, fallback = run_embedded(site, without_state(pages))
+        print('{}: XPathExtractor {:.1f} µs/page, embedded JSON {:.1f} µs/page ({:.0%} less CPU), '
+              'byte search without state {:.1f} µs/page'.format(
+                  site, compiled * 1e6, embedded * 1e6, 1 - embedded / compiled, fallback * 1e6))
+        shares = agreement(site, items, json_items)
+        print('{}: fields in agreement: {}'.format(site, ', '.join(
+            '{} {:.1%}'.format(field, share) for field, share in sorted(shares.items()))))
+
+
+if __name__ == '__main__':
+    main()
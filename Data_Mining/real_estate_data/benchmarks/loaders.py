@@ -0,0 +1,126 @@
+"""
+Microbenchmark of the item loaders.
+
+Compares the ``ItemLoader`` subclasses of :mod:`immo_crawl.items` with the
+:class:`~immo_crawl.items.CompiledLoader` compiled from them, for the CPU time and the memory
+per item (including the strings created by the input processors). The values are extracted
+from the recorded detail page fixtures beforehand, so that only the loading is measured. Both
+loaders have to give the same items, also for values that are missing or truncated at random.
+
+Usage (from ``Data_Mining/real_estate_data``)::
+
+    python -m benchmarks.loaders --pages 2000
+"""
+import time
+import random
+import argparse
+import tracemalloc
+from datetime import date
+
+from scrapy.http import HtmlResponse, Request
+
+from benchmarks.extraction import SITES, detail_pages
+from immo_crawl.items import (ImmoCrawlItem, PriceCheckItem, PriceCheckLoader, HomeGateLoader,
+                              ImmoScoutLoader, CompiledLoader)
+from immo_crawl.spiders.pricecheck_spider import PricecheckSpider
+
+LOADERS = {
+    'homegate': (HomeGateLoader, ImmoCrawlItem),
+    'immoscout': (ImmoScoutLoader, ImmoCrawlItem),
+    'pricecheck': (PriceCheckLoader, PriceCheckItem),
+}
+
+
+def extracted_values(site, count):
+    """
+    Returns the extracted values and the single values of ``count`` detail pages of a site.
+    """
+    today = date.today()
+    pages = detail_pages('immoscout' if site == 'pricecheck' else site, count)
+    values = []
+    for url, body in pages:
+        response = HtmlResponse(url, body=body, encoding='utf-8', request=Request(url))
+        if site == 'pricecheck':
+            extracted = {'price_chf': response.xpath(PricecheckSpider.fingerprint_xpath).getall()}
+            values.append((extracted, {'url': url, 'date': today}))
+        else:
+            single = {'date_scraped': today, 'date_last_seen': today, 'url': url}
+            if site == 'homegate':
+                single['canton'] = 'ZH'
+            values.append((SITES[site][0].extractor.extract(response), single))
+    return values
+
+
+def truncated(values, seed=0):
+    """
+    Returns the values with a random number of values removed from the end of each field.
+    """
+    rng = random.Random(seed)
+    return [({field: field_values[:rng.randint(0, len(field_values))] for field, field_values in extracted.items()},
+             single) for extracted, single in values]
+
+
+def item_loader(site, values):
+    loader_cls, item_cls = LOADERS[site]
+    items = []
+    for extracted, single in values:
+        loader = loader_cls(item=item_cls())
+        for field, field_values in extracted.items():
+            loader.add_value(field, field_values)
+        for field, value in single.items():
+            loader.add_value(field, value)
+        items.append(loader.load_item())
+    return items
+
+
+def compiled_loader(site, values):
+    compiled = CompiledLoader(*LOADERS[site])
+    return [compiled.load(extracted, **single) for extracted, single in values]
+
+
+def compiled_items(site, values):
+    return [record.item() for record in compiled_loader(site, values)]
+
+
+def measure(load, site, values, repeat=3):
+    """
+    Returns the CPU time per item of ``load`` (best of ``repeat`` runs) and the memory per item
+    held by its results.
+    """
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = time.process_time()
+        load(site, values)
+        seconds = min(seconds, (time.process_time() - start) / len(values))
+
+    tracemalloc.start()
+    results = load(site, values)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del results
+    return seconds, size / len(values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the ItemLoaders with the compiled loaders.')
+    parser.add_argument('--pages', type=int, default=1000, help='detail pages per loader')
+    args = parser.parse_args()
+
+    for site in LOADERS:
+        values = extracted_values(site, args.pages)
+        for case in (values, truncated(values)):
+            items = item_loader(site, case)
+            records = compiled_loader(site, case)
+            assert [dict(item) for item in items] == [dict(record.item()) for record in records], site
+
+        baseline, baseline_size = measure(item_loader, site, values)
+        compiled, size = measure(compiled_loader, site, values)
+        converted, _ = measure(compiled_items, site, values)
+        print('{}: ItemLoader {:.1f} µs/item, CompiledLoader {:.1f} µs/record ({:.0%} less CPU), '
+              '{:.1f} µs/item including the conversion to an item'.format(
+                  site, baseline * 1e6, compiled * 1e6, 1 - compiled / baseline, converted * 1e6))
+        print('{}: {:.0f} bytes/item, {:.0f} bytes/record'.format(site, baseline_size, size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Offline throughput benchmark for the spiders and pipelines of :mod:`immo_crawl`.
+
+The spiders are run against the local HTTP stand-in of :mod:`benchmarks.server` and
+write to the tables of the schema ``immo_benchmark`` in a local Postgres database
+(cf. ``benchmarks/schema.sql``). Each spider runs in its own process, the report
+contains pages/sec, items/sec, latency percentiles per callback and the peak RSS.
+
+Usage (from ``Data_Mining/real_estate_data``)::
+
+    python -m benchmarks.replay --dsn postgresql://localhost/immo --spider homegate immoscout pricecheck
+"""
+import re
+import json
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from datetime import date
+from pathlib import Path
+
+import psycopg2
+from psycopg2.extensions import make_dsn
+from psycopg2.extras import execute_values
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+
+from benchmarks import server
+from immo_crawl.spiders.homegate_spider import HomegateSpider
+from immo_crawl.spiders.immoscout_spider import ImmoscoutSpider
+from immo_crawl.spiders.pricecheck_spider import PricecheckSpider
+
+SPIDERS = {'homegate': HomegateSpider, 'immoscout': ImmoscoutSpider, 'pricecheck': PricecheckSpider}
+SCHEMA = Path(__file__).parent / 'schema.sql'
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of the sorted list ``values``.
+    """
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+class CallbackTimer(object):
+    """
+    Spider middleware that measures the time spent in each spider callback. Only the time
+    in which the callback generator is running is counted, not the time the engine needs
+    to process its output.
+    """
+
+    def __init__(self, crawler):
+        self.durations = crawler.benchmark_durations = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider):
+        callback = response.request.callback or spider.parse
+        durations = self.durations.setdefault(getattr(callback, '__name__', 'parse'), [])
+        elapsed = 0.0
+        result = iter(result)
+        while True:
+            start = time.perf_counter()
+            try:
+                output = next(result)
+            except StopIteration:
+                durations.append(elapsed + time.perf_counter() - start)
+                return
+            elapsed += time.perf_counter() - start
+            yield output
+
+
+class BenchmarkStats(object):
+    """
+    Extension that counts the responses and items of a run and creates the report
+    when the spider is closed.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.pages = 0
+        self.items = 0
+        self.dropped = 0
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.response_received, signal=signals.response_received)
+        crawler.signals.connect(self.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(self.item_dropped, signal=signals.item_dropped)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.start = time.perf_counter()
+
+    def response_received(self, response, request, spider):
+        self.pages += 1
+
+    def item_scraped(self, item, response, spider):
+        self.items += 1
+
+    def item_dropped(self, item, response, exception, spider):
+        self.dropped += 1
+
+    def spider_closed(self, spider, reason):
+        elapsed = time.perf_counter() - self.start
+        callbacks = {}
+        for name, durations in getattr(self.crawler, 'benchmark_durations', {}).items():
+            if not durations:
+                continue
+            durations = sorted(durations)
+            callbacks[name] = {
+                'calls': len(durations),
+                'p50_ms': percentile(durations, 0.50) * 1000,
+                'p90_ms': percentile(durations, 0.90) * 1000,
+                'p99_ms': percentile(durations, 0.99) * 1000,
+                'max_ms': durations[-1] * 1000,
+            }
+        self.crawler.benchmark_report = {
+            'spider': spider.name,
+            'reason': reason,
+            'seconds': elapsed,
+            'pages': self.pages,
+            'items': self.items,
+            'dropped': self.dropped,
+            'pages_per_sec': self.pages / elapsed,
+            'items_per_sec': self.items / elapsed,
+            'callbacks': callbacks,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+
+
+def reset_database(dsn):
+    """
+    Creates empty benchmark tables in the schema ``immo_benchmark``.
+    """
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        cur.execute(SCHEMA.read_text())
+    conn.close()
+
+
+def seed_database(dsn, urls):
+    """
+    Writes the given URLs with their current price to the benchmark tables,
+    so that they count as visited by the crawl spiders and are checked by the pricecheck spider.
+    """
+    today = date.today()
+    rows = []
+    for url in urls:
+        ad = server.listing(int(url.rstrip('/').rsplit('/', 1)[1]))
+        rows.append((ad['street'], ad['zip_code'], ad['city'], ad['canton'], ad['price'], ad['rooms'],
+                     ad['area'], ad['floor'], ad['utilities'], today, today, today, url))
+    with psycopg2.connect(dsn) as conn, conn.cursor() as cur:
+        execute_values(cur, 'INSERT INTO eva_data (address, zip, city, canton, price_chf, rooms, area_m2, '
+                            'floor, utilities_chf, date_available, date_scraped, date_last_seen, url) VALUES %s;',
+                       rows)
+        execute_values(cur, 'INSERT INTO eva_prices (url, date, price_chf) VALUES %s;',
+                       [(row[-1], today, row[4]) for row in rows])
+    conn.close()
+
+
+def canton_slugs(spider_cls):
+    return [re.search(r'kanton-([\w-]+)', path).group(1) for path in spider_cls.start_paths]
+
+
+def run_spider(name, settings, spider_kwargs, report_queue):
+    """
+    Runs a spider in the current process and puts the report into ``report_queue``.
+    """
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(SPIDERS[name])
+    process.crawl(crawler, **spider_kwargs)
+    process.start()
+    report_queue.put(getattr(crawler, 'benchmark_report', {'spider': name, 'reason': 'failed'}))
+
+
+def benchmark(name, args, base_url):
+    """
+    Prepares the database for a spider, runs it in a separate process and returns the report.
+    The validators of the pricecheck are stored in a temporary file instead of the cache of
+    the project, since the URLs of the stand-in change with every run.
+    """
+    dsn = make_dsn(args.dsn, options='-c search_path=immo_benchmark')
+    reset_database(dsn)
+    site = 'homegate' if name == 'homegate' else 'immoscout'
+    slugs = canton_slugs(SPIDERS[site])[:args.cantons]
+    urls = [base_url + path for path in server.detail_paths(site, slugs, args.pages, args.ads)]
+    if name == 'pricecheck':
+        seed_database(dsn, urls)
+    else:
+        seed_database(dsn, urls[:int(len(urls) * args.known)])
+
+    settings = get_project_settings()
+    settings.setdict({
+        'DB_DSN': dsn,
+        'ROBOTSTXT_OBEY': False,
+        'DOWNLOAD_DELAY': 0,
+        'AUTOTHROTTLE_ENABLED': False,
+        'CONCURRENT_REQUESTS': args.concurrency,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': args.concurrency,
+        'PARSER_PROCESSES': args.parser_processes,
+        'LOG_LEVEL': 'WARNING',
+        'TELNETCONSOLE_ENABLED': False,
+        'EXTENSIONS': {'benchmarks.replay.BenchmarkStats': 0},
+        'SPIDER_MIDDLEWARES': {'benchmarks.replay.CallbackTimer': 1000},
+    }, priority='cmdline')
+    spider_kwargs = {}
+    if name != 'pricecheck':
+        spider_kwargs = {'base_url': base_url, 'allowed_domains': ['127.0.0.1'],
+                         'start_paths': SPIDERS[name].start_paths[:args.cantons]}
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        settings.set('CONDITIONAL_CACHE_PATH', str(Path(cache_dir) / 'validators.sqlite'), priority='cmdline')
+        report_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_spider, args=(name, settings, spider_kwargs, report_queue))
+        process.start()
+        report = report_queue.get()
+        process.join()
+    return report
+
+
+def print_report(report):
+    print('{spider}: {pages} pages, {items} items, {dropped} dropped in {seconds:.1f}s'.format(**report))
+    print('  {pages_per_sec:.1f} pages/s, {items_per_sec:.1f} items/s, peak RSS {peak_rss_mb:.0f} MB'.format(
+        **report))
+    for name, callback in sorted(report['callbacks'].items()):
+        print('  {}: {calls} calls, p50 {p50_ms:.2f} ms, p90 {p90_ms:.2f} ms, p99 {p99_ms:.2f} ms, '
+              'max {max_ms:.2f} ms'.format(name, **callback))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded pages through the spiders and pipelines.')
+    parser.add_argument('--dsn', required=True, help='connection string of a local Postgres database')
+    parser.add_argument('--spider', nargs='+', choices=sorted(SPIDERS), default=sorted(SPIDERS))
+    parser.add_argument('--cantons', type=int, default=4, help='number of cantons to crawl')
+    parser.add_argument('--pages', type=int, default=5, help='result pages per canton')
+    parser.add_argument('--ads', type=int, default=20, help='advertisements per result page')
+    parser.add_argument('--known', type=float, default=0.5,
+                        help='share of advertisements that are already in the database')
+    parser.add_argument('--latency', type=float, default=0.0, help='response delay of the server in seconds')
+    parser.add_argument('--price-changes', type=float, default=0.1,
+                        help='share of advertisements whose price changed since the last run')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--parser-processes', type=int, default=0,
+                        help='worker processes for the detail pages (cf. PARSER_PROCESSES)')
+    parser.add_argument('--json', help='file to which the reports are written')
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=server.serve, args=(port_queue, args.pages, args.ads, args.latency, args.price_changes),
+        daemon=True)
+    server_process.start()
+    base_url = 'http://127.0.0.1:{}'.format(port_queue.get())
+
+    reports = []
+    try:
+        for name in args.spider:
+            report = benchmark(name, args, base_url)
+            reports.append(report)
+            if 'pages' in report:
+                print_report(report)
+            else:
+                print('{}: run failed'.format(name))
+    finally:
+        server_process.terminate()
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(reports, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
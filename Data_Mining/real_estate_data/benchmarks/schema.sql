@@ -0,0 +1,29 @@
+-- Tables used by the replay benchmark. They are created in a separate schema,
+-- so that the benchmark can be run against any local Postgres database.
+DROP SCHEMA IF EXISTS immo_benchmark CASCADE;
+CREATE SCHEMA immo_benchmark;
+SET search_path TO immo_benchmark;
+
+CREATE TABLE eva_data (
+    id serial PRIMARY KEY,
+    address text,
+    zip text,
+    city text,
+    canton text,
+    price_chf integer,
+    rooms text,
+    area_m2 integer,
+    floor text,
+    utilities_chf integer,
+    date_available date,
+    date_scraped date,
+    date_last_seen date,
+    url text
+);
+
+CREATE TABLE eva_prices (
+    id serial PRIMARY KEY,
+    url text,
+    date date,
+    price_chf integer
+);
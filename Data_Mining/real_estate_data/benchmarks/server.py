@@ -0,0 +1,227 @@
+"""
+Local HTTP stand-in for www.homegate.ch and www.immoscout24.ch.
+
+The result pages and detail pages are rendered from the recorded HTML fixtures in
+``benchmarks/fixtures``. The listings are generated deterministically from their id,
+so that the benchmark can seed the database with the same URLs the server returns.
+Every page is sent with an ``ETag``, and requests with a matching ``If-None-Match``
+header are answered with 304 Not Modified.
+
+To test the throttling of the crawler, the server can slow down when more than ``capacity``
+requests are in progress (``slowdown`` seconds per additional request), and answer with
+429 Too Many Requests when more than ``rate_limit`` requests arrive within a second.
+"""
+import re
+import hashlib
+import time
+import random
+import threading
+import zlib
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from string import Template
+from urllib.parse import urlsplit, parse_qs
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+STREETS = ['Bahnhofstrasse', 'Hauptstrasse', 'Dorfstrasse', 'Seestrasse', 'Kirchweg', 'Gartenstrasse']
+CITIES = [('8001', 'Zürich', 'ZH'), ('3011', 'Bern', 'BE'), ('4051', 'Basel', 'BS'),
+          ('6003', 'Luzern', 'LU'), ('9000', 'St. Gallen', 'SG'), ('1003', 'Lausanne', 'VD')]
+FLOORS = ['EG', '1. OG', '2. OG', '3. OG', '4. OG']
+
+HOMEGATE_RESULTS = re.compile(r'^/mieten/immobilien/kanton-([\w-]+)/trefferliste$')
+HOMEGATE_DETAIL = re.compile(r'^/mieten/(\d+)$')
+IMMOSCOUT_RESULTS = re.compile(r'^/de/immobilien/mieten/kanton-([\w-]+)$')
+IMMOSCOUT_DETAIL = re.compile(r'^/de/d/[\w-]+/(\d+)$')
+
+
+def load_fixture(name):
+    return Template((FIXTURES / name).read_text(encoding='utf-8'))
+
+
+def listing_id(slug, page, position):
+    """
+    Returns the id of the listing at ``position`` on result page ``page`` of a canton.
+    """
+    return (zlib.crc32(slug.encode('utf-8')) % 100000) * 100000 + page * 100 + position
+
+
+def listing(ad_id, price_change_ratio=0.0):
+    """
+    Returns the data of a listing. With a probability of ``price_change_ratio`` the
+    price differs from the price that was used to seed the database.
+    """
+    rng = random.Random(ad_id)
+    zip_code, city, canton = rng.choice(CITIES)
+    price = rng.randrange(900, 4500, 10)
+    if price_change_ratio and random.Random(ad_id + 1).random() < price_change_ratio:
+        price += 50
+    ad = {
+        'id': ad_id,
+        'street': '{} {}'.format(rng.choice(STREETS), rng.randint(1, 120)),
+        'zip_code': zip_code,
+        'city': city,
+        'city_slug': city.lower().replace('. ', '-').replace('ü', 'ue'),
+        'canton': canton,
+        'rooms': rng.choice(['1.5', '2', '2.5', '3.5', '4.5', '5.5']),
+        'area': rng.randint(25, 180),
+        'price': price,
+        'price_text': '{:,}'.format(price).replace(',', '’'),
+        'utilities': rng.randrange(100, 400, 10),
+        'floor': rng.choice(FLOORS),
+        'date_available': '01.{:02d}.2026'.format(rng.randint(1, 12)),
+    }
+    # The embedded JSON state of the detail pages has the date in ISO format
+    day, month, year = ad['date_available'].split('.')
+    ad['available_from'] = '{}-{}-{}'.format(year, month, day)
+    return ad
+
+
+def homegate_detail_path(ad_id):
+    return '/mieten/{}'.format(ad_id)
+
+
+def immoscout_detail_path(ad_id):
+    return '/de/d/wohnung-mieten-{}/{}'.format(listing(ad_id)['city_slug'], ad_id)
+
+
+def detail_paths(site, slugs, pages, ads_per_page):
+    """
+    Returns the paths of all detail pages the server lists for the given cantons.
+    """
+    detail_path = homegate_detail_path if site == 'homegate' else immoscout_detail_path
+    return [detail_path(listing_id(slug, page, position))
+            for slug in slugs
+            for page in range(1, pages + 1)
+            for position in range(ads_per_page)]
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """
+    Renders the fixtures for the requested path. The options of the server are set
+    as class attributes by :func:`serve`.
+    """
+    pages = 5
+    ads_per_page = 20
+    latency = 0.0
+    price_change_ratio = 0.0
+    capacity = 0
+    slowdown = 0.0
+    rate_limit = 0
+    templates = {}
+    lock = threading.Lock()
+    in_progress = 0
+    arrivals = deque()
+
+    def do_GET(self):
+        if self.throttled():
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        cls = type(self)
+        with cls.lock:
+            cls.in_progress += 1
+            load = cls.in_progress
+        try:
+            delay = self.latency
+            if self.capacity and load > self.capacity:
+                delay += self.slowdown * (load - self.capacity)
+            if delay:
+                time.sleep(delay)
+            self.render()
+        finally:
+            with cls.lock:
+                cls.in_progress -= 1
+
+    def throttled(self):
+        """
+        Returns whether more than :attr:`rate_limit` requests arrived within the last second.
+        """
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            while self.arrivals and self.arrivals[0] < now - 1.0:
+                self.arrivals.popleft()
+            self.arrivals.append(now)
+            return len(self.arrivals) > self.rate_limit
+
+    def render(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        for pattern, render in ((HOMEGATE_RESULTS, self.homegate_results),
+                                (HOMEGATE_DETAIL, self.homegate_detail),
+                                (IMMOSCOUT_RESULTS, self.immoscout_results),
+                                (IMMOSCOUT_DETAIL, self.immoscout_detail)):
+            match = pattern.match(url.path)
+            if match:
+                self.send_html(render(match.group(1), query))
+                return
+        self.send_error(404)
+
+    def send_html(self, body):
+        body = body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    def homegate_results(self, slug, query):
+        page = int(query.get('ep', ['1'])[0])
+        cards = [self.templates['homegate_card'].substitute(listing(listing_id(slug, page, position)))
+                 for position in range(self.ads_per_page)]
+        next_page = ''
+        if page < self.pages:
+            next_page = '<a aria-label="Zur nächsten Seite" href="?ep={}">›</a>'.format(page + 1)
+        return self.templates['homegate_results'].substitute(
+            canton=slug, count=self.pages * self.ads_per_page, cards='\n'.join(cards), next_page=next_page)
+
+    def homegate_detail(self, ad_id, query):
+        return self.templates['homegate_detail'].substitute(
+            listing(int(ad_id), self.price_change_ratio))
+
+    def immoscout_results(self, slug, query):
+        page = int(query.get('pn', ['1'])[0])
+        cards = [self.templates['immoscout_card'].substitute(listing(listing_id(slug, page, position)), page=page)
+                 for position in range(self.ads_per_page)]
+        page_links = '\n'.join('      <a href="?pn={0}">{0}</a>'.format(number)
+                               for number in range(1, self.pages + 1))
+        return self.templates['immoscout_results'].substitute(
+            canton=slug, count=self.pages * self.ads_per_page, cards='\n'.join(cards), page_links=page_links)
+
+    def immoscout_detail(self, ad_id, query):
+        return self.templates['immoscout_detail'].substitute(
+            listing(int(ad_id), self.price_change_ratio))
+
+
+def serve(port_queue, pages=5, ads_per_page=20, latency=0.0, price_change_ratio=0.0,
+          capacity=0, slowdown=0.0, rate_limit=0):
+    """
+    Starts the server on a free local port and puts the port into ``port_queue``.
+    Runs until the process is terminated.
+    """
+    ReplayHandler.pages = pages
+    ReplayHandler.ads_per_page = ads_per_page
+    ReplayHandler.latency = latency
+    ReplayHandler.price_change_ratio = price_change_ratio
+    ReplayHandler.capacity = capacity
+    ReplayHandler.slowdown = slowdown
+    ReplayHandler.rate_limit = rate_limit
+    ReplayHandler.templates = {path.stem: load_fixture(path.name) for path in FIXTURES.glob('*.html')}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ReplayHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
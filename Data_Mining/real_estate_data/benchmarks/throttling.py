@@ -0,0 +1,133 @@
+"""
+Throttling benchmark of :class:`~immo_crawl.middlewares.AdaptiveConcurrencyMiddleware`.
+
+Requests detail pages from the local HTTP stand-in of :mod:`benchmarks.server`, which slows
+down above a number of requests in progress and answers with 429 above a request rate. The
+pages are requested once with the fixed delay and AutoThrottle settings that the spiders
+used before (``static``) and once with the adaptive controller of the project settings
+(``adaptive``). The report contains the pages/sec, the throttled responses and the
+decisions and final concurrency and delay of the controller. No database is needed.
+
+Usage (from ``Data_Mining/real_estate_data``)::
+
+    python -m benchmarks.throttling --requests 200 --capacity 4 --slowdown 0.25 --rate-limit 3
+
+The adaptive mode uses the ceilings of a portal in ``ADAPTIVE_DOMAIN_LIMITS`` (``--portal``,
+default ``homegate.ch``) for the stand-in, since its domain is not one of the portals.
+``--min-delay`` and ``--max-concurrency`` override them.
+"""
+import time
+import argparse
+import multiprocessing
+
+import scrapy
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+
+from benchmarks import server
+
+MODES = {
+    'static': {'ADAPTIVE_CONCURRENCY_ENABLED': False, 'AUTOTHROTTLE_ENABLED': True,
+               'AUTOTHROTTLE_TARGET_CONCURRENCY': 1.0, 'CONCURRENT_REQUESTS_PER_DOMAIN': 8},
+    'adaptive': {},
+}
+
+
+class ProbeSpider(scrapy.Spider):
+    """
+    Requests the given URLs and only counts the responses.
+    """
+    name = 'probe'
+
+    def parse(self, response):
+        self.crawler.stats.inc_value('probe/pages')
+
+
+def run_probe(mode, urls, report_queue):
+    """
+    Requests the URLs in the current process and puts the stats into ``report_queue``.
+    """
+    settings = get_project_settings()
+    settings.setdict({
+        'ROBOTSTXT_OBEY': False,
+        'LOG_LEVEL': 'WARNING',
+        'TELNETCONSOLE_ENABLED': False,
+        'METRICS_ENABLED': False,
+        'EXTENSIONS': {},
+        'ITEM_PIPELINES': {},
+        'SPIDER_MIDDLEWARES': {},
+        'RETRY_TIMES': 5,
+    }, priority='cmdline')
+    settings.setdict(MODES[mode], priority='cmdline')
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(ProbeSpider)
+    start = time.monotonic()
+    process.crawl(crawler, start_urls=urls)
+    process.start()
+    stats = crawler.stats.get_stats()
+    stats['probe/seconds'] = time.monotonic() - start
+    report_queue.put({key: value for key, value in stats.items()
+                      if key.startswith(('probe/', 'immo_crawl/adaptive/', 'downloader/response_status_count/'))
+                      or key == 'retry/count'})
+
+
+def print_report(mode, stats):
+    pages = stats.get('probe/pages', 0)
+    seconds = stats['probe/seconds']
+    print('{}: {} pages in {:.1f}s ({:.1f} pages/s), {} throttled responses, {} retries'.format(
+        mode, pages, seconds, pages / seconds, stats.get('downloader/response_status_count/429', 0),
+        stats.get('retry/count', 0)))
+    for key, value in sorted(stats.items()):
+        if key.startswith('immo_crawl/adaptive/'):
+            print('  {}: {}'.format(key[len('immo_crawl/adaptive/'):], value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the static throttling with the adaptive controller.')
+    parser.add_argument('--mode', nargs='+', choices=sorted(MODES), default=['adaptive', 'static'])
+    parser.add_argument('--requests', type=int, default=200, help='number of detail pages requested')
+    parser.add_argument('--latency', type=float, default=0.05, help='response delay of the server in seconds')
+    parser.add_argument('--capacity', type=int, default=4,
+                        help='requests in progress above which the server slows down')
+    parser.add_argument('--slowdown', type=float, default=0.25,
+                        help='additional delay in seconds per request above the capacity')
+    parser.add_argument('--rate-limit', type=int, default=3,
+                        help='requests per second above which the server answers with 429')
+    parser.add_argument('--portal', default='homegate.ch',
+                        help='domain in ADAPTIVE_DOMAIN_LIMITS whose limits the adaptive mode uses')
+    parser.add_argument('--min-delay', type=float,
+                        help='minimum delay of the adaptive mode (default: limit of the portal), '
+                             'with 0 the concurrency limits the rate')
+    parser.add_argument('--max-concurrency', type=int,
+                        help='maximum concurrency of the adaptive mode (default: limit of the portal)')
+    args = parser.parse_args()
+    limits = dict(get_project_settings().getdict('ADAPTIVE_DOMAIN_LIMITS').get(args.portal, {}))
+    if args.min_delay is not None:
+        limits['min_delay'] = args.min_delay
+    if args.max_concurrency is not None:
+        limits['max_concurrency'] = args.max_concurrency
+    MODES['adaptive']['ADAPTIVE_DOMAIN_LIMITS'] = {'127.0.0.1': limits}
+
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=server.serve, args=(port_queue, ), daemon=True,
+        kwargs={'latency': args.latency, 'capacity': args.capacity, 'slowdown': args.slowdown,
+                'rate_limit': args.rate_limit})
+    server_process.start()
+    base_url = 'http://127.0.0.1:{}'.format(port_queue.get())
+    urls = [base_url + server.homegate_detail_path(ad_id) for ad_id in range(args.requests)]
+
+    try:
+        for mode in args.mode:
+            report_queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_probe, args=(mode, urls, report_queue))
+            process.start()
+            stats = report_queue.get()
+            process.join()
+            print_report(mode, stats)
+    finally:
+        server_process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import time
+import logging
+import threading
+import psycopg2
+from contextlib import contextmanager
+from datetime import date
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from scrapy import signals
+from twisted.internet import defer, reactor, threads
+from twisted.python.threadpool import ThreadPool
+from immo_crawl.metrics import get_metrics
+from immo_crawl.history import record_checks, update_current_prices, write_prices
+from immo_crawl.schema import migrate
+from immo_crawl.credentials import HOSTNAME, USERNAME, PASSWORD, DATABASE
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """
+    Pool of database connections that is shared by the spiders and pipelines of a crawler
+    (cf. :func:`get_pool`). Connections that were idle for longer than
+    :attr:`health_check_interval` are checked before they are handed out, and the number
+    and duration of the operations are recorded in the crawler stats.
+
+    Operations started with :meth:`run` are executed in a thread pool, so that the
+    reactor thread is not blocked by the database. At most ``DB_WRITE_QUEUE_SIZE``
+    operations are pending at the same time, further operations wait in the queue.
+
+    Large result sets are read with :meth:`stream`, which fetches the rows in batches of
+    :attr:`itersize` from a server-side cursor.
+
+    The connection parameters are taken from :mod:`immo_crawl.credentials` unless a
+    connection string is given in ``DB_DSN``.
+
+    Attributes:
+        pool (psycopg2.pool.ThreadedConnectionPool): the underlying connection pool
+        health_check_interval (float): seconds of inactivity after which a connection is checked
+        stats (scrapy.statscollectors.StatsCollector): collector for the operation statistics
+        metrics (:class:`~immo_crawl.metrics.Metrics`): histograms of the operation durations (optional)
+        threadpool (twisted.python.threadpool.ThreadPool): threads that execute the operations
+        queue (twisted.internet.defer.DeferredSemaphore): limits the number of pending operations
+        itersize (int): number of rows that :meth:`stream` fetches at once
+    """
+
+    def __init__(self, min_size=1, max_size=4, health_check_interval=60.0, stats=None,
+                 threads=2, queue_size=4, dsn=None, itersize=10000, metrics=None):
+        if dsn:
+            self.pool = ThreadedConnectionPool(min_size, max_size, dsn)
+        else:
+            self.pool = ThreadedConnectionPool(
+                min_size, max_size, host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
+        self.health_check_interval = health_check_interval
+        self.stats = stats
+        self.metrics = metrics
+        self.last_used = {}
+        self.lock = threading.Lock()
+        self.threadpool = ThreadPool(minthreads=0, maxthreads=threads, name='immo_crawl.database')
+        self.threadpool.start()
+        self.queue = defer.DeferredSemaphore(queue_size)
+        self.itersize = itersize
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(min_size=crawler.settings.getint('DB_POOL_MIN_SIZE', 1),
+                   max_size=crawler.settings.getint('DB_POOL_MAX_SIZE', 4),
+                   health_check_interval=crawler.settings.getfloat('DB_HEALTH_CHECK_INTERVAL', 60.0),
+                   stats=crawler.stats,
+                   threads=crawler.settings.getint('DB_WRITE_THREADS', 2),
+                   queue_size=crawler.settings.getint('DB_WRITE_QUEUE_SIZE', 4),
+                   dsn=crawler.settings.get('DB_DSN'),
+                   itersize=crawler.settings.getint('DB_CURSOR_ITERSIZE', 10000),
+                   metrics=get_metrics(crawler))
+
+    @contextmanager
+    def connection(self, operation='query'):
+        """
+        Lends a connection from the pool. The transaction is committed when the block
+        is left without an error and rolled back otherwise.
+
+        Parameters:
+            operation (str): name under which the operation is recorded in the stats
+
+        Yields:
+            psycopg2.extensions.connection: connection to the database
+        """
+        conn = self.checkout()
+        start = time.monotonic()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.last_used[id(conn)] = time.monotonic()
+            self.pool.putconn(conn, close=bool(conn.closed))
+            self.record(operation, time.monotonic() - start)
+
+    def stream(self, operation, query, args=None):
+        """
+        Yields the rows of a query one by one. The rows are fetched in batches of :attr:`itersize`
+        from a named server-side cursor, so that the memory needed does not grow with the size of
+        the result. The connection is lent until all rows have been read or the generator is closed.
+
+        Parameters:
+            operation (str): name under which the operation is recorded in the stats, also used as cursor name
+            query (str): the SQL query
+            args (tuple): parameters of the query
+
+        Yields:
+            tuple: a row of the result
+        """
+        with self.connection(operation) as conn, conn.cursor(name=operation) as cur:
+            cur.itersize = self.itersize
+            cur.execute(query, args)
+            yield from cur
+
+    def run(self, operation, func, *args):
+        """
+        Executes ``func(conn, *args)`` with a connection of the pool in the thread pool.
+        The transaction is committed when ``func`` returns.
+
+        Parameters:
+            operation (str): name under which the operation is recorded in the stats
+            func (callable): function that receives the connection as first argument
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with the return value of ``func``
+        """
+        return self.defer(self.call, operation, func, *args)
+
+    def call(self, operation, func, *args):
+        with self.connection(operation) as conn:
+            return func(conn, *args)
+
+    def defer(self, func, *args):
+        """
+        Executes ``func(*args)`` in the thread pool as soon as the queue has room.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with the return value of ``func``
+        """
+        return self.queue.run(threads.deferToThreadPool, reactor, self.threadpool, func, *args)
+
+    def wait_for_capacity(self):
+        """
+        Returns a Deferred that fires as soon as the queue has room for another operation.
+        Pipelines return it to pause the intake of items while the queue is full.
+        """
+        if self.queue.tokens > 0:
+            return defer.succeed(None)
+        return self.queue.acquire().addCallback(lambda semaphore: semaphore.release())
+
+    def checkout(self):
+        """
+        Takes a connection from the pool. Connections that are closed or do not pass the
+        health check are discarded and replaced by a new connection.
+        """
+        conn = self.pool.getconn()
+        last_used = self.last_used.get(id(conn))
+        if not conn.closed and (last_used is None or
+                                time.monotonic() - last_used < self.health_check_interval):
+            return conn
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+            return conn
+        except psycopg2.Error:
+            self.record('health_check_failed')
+            self.last_used.pop(id(conn), None)
+            self.pool.putconn(conn, close=True)
+            return self.pool.getconn()
+
+    def record(self, operation, duration=None):
+        """
+        Counts an operation and adds its duration to the crawler stats and metrics.
+        """
+        if self.metrics is not None and duration is not None:
+            self.metrics.observe('db_operation', duration, operation=operation)
+        if self.stats is None:
+            return
+        with self.lock:
+            self.stats.inc_value('immo_crawl/db/{}/count'.format(operation))
+            if duration is not None:
+                self.stats.inc_value('immo_crawl/db/{}/time'.format(operation), duration)
+
+    def close(self):
+        """
+        Stops the thread pool and closes all connections of the pool.
+        """
+        if self.threadpool.started:
+            self.threadpool.stop()
+        if not self.pool.closed:
+            self.pool.closeall()
+
+
+def get_pool(crawler):
+    """
+    Returns the :class:`ConnectionPool` of the crawler. The pool is created on first use
+    and closed when the engine is stopped. Unless ``DB_MIGRATE`` is disabled, the pending
+    migrations of the schema are applied when the pool is created (cf. :mod:`immo_crawl.schema`).
+
+    Parameters:
+        crawler (scrapy.crawler.Crawler): the running crawler
+    """
+    pool = getattr(crawler, 'db_pool', None)
+    if pool is None:
+        pool = crawler.db_pool = ConnectionPool.from_crawler(crawler)
+        crawler.signals.connect(pool.close, signal=signals.engine_stopped)
+        if crawler.settings.getbool('DB_MIGRATE', True):
+            with pool.connection('migrate') as conn:
+                migrate(conn)
+    return pool
+
+
+class SeenUrlUpdater(object):
+    """
+    Collects the URLs of advertisements that are already stored in the database and
+    sets their ``date_last_seen`` with a single UPDATE per batch instead of one
+    UPDATE per URL.
+
+    If the price of an advertisement is shown on the results page, it is compared with the
+    current price in the same transaction. Changed prices are added to the price history,
+    and the URL counts as checked, so that the pricecheck spider does not need to request it
+    (cf. :class:`~immo_crawl.scheduling.PriceCheckScheduler`).
+
+    Attributes:
+        pool (ConnectionPool): pool from which the connections are taken
+        batch_size (int): number of collected URLs that triggers an update
+        stats (scrapy.statscollectors.StatsCollector): stats of the crawler (optional)
+        history_mode (str): storage mode of the price history (cf. :func:`~immo_crawl.history.write_prices`)
+        urls (set): URLs that have been seen since the last update
+        prices (dict): price shown on the results page for each of the :attr:`urls` that has one
+        pending (set): Deferreds of the updates that have not finished yet
+    """
+
+    def __init__(self, pool, batch_size=1000, stats=None, history_mode='points'):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.stats = stats
+        self.history_mode = history_mode
+        self.urls = set()
+        self.prices = {}
+        self.pending = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(get_pool(crawler), batch_size=crawler.settings.getint('SEEN_URLS_BATCH_SIZE', 1000),
+                   stats=crawler.stats, history_mode=crawler.settings.get('PRICE_HISTORY_MODE', 'points'))
+
+    def add(self, url, price=None):
+        """
+        Adds a URL that was seen on a results page. The database is updated
+        as soon as :attr:`batch_size` URLs have been collected.
+
+        Parameters:
+            url (str): URL of the advertisement
+            price (int): price shown on the results page, if any
+        """
+        self.urls.add(url)
+        if price is not None:
+            self.prices[url] = price
+        if len(self.urls) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Sets the current date as ``date_last_seen`` for all collected URLs and stores the 
+        changed prices. The update runs in the thread pool of :attr:`pool`.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when all pending updates have finished
+        """
+        if self.urls:
+            urls, self.urls = list(self.urls), set()
+            prices, self.prices = self.prices, {}
+            d = self.pool.run('update_seen_urls', self.update, urls, prices)
+            d.addCallback(self.updated, prices)
+            d.addErrback(lambda failure: logger.error(
+                'date_last_seen of %d URLs could not be updated: %s', len(urls), failure.value))
+            self.pending.add(d)
+            d.addBoth(lambda _: self.pending.discard(d))
+        return defer.DeferredList(list(self.pending))
+
+    def update(self, conn, urls, prices):
+        today = date.today()
+        with conn.cursor() as cur:
+            cur.execute('UPDATE eva_data SET date_last_seen = %s WHERE url = ANY(%s);', (today, urls))
+            if not prices:
+                return 0
+            rows = execute_values(cur, 'SELECT v.url, v.price_chf FROM (VALUES %s) AS v (url, price_chf) '
+                                       'JOIN eva_current_prices c ON c.url = v.url '
+                                       'WHERE c.price_chf IS DISTINCT FROM v.price_chf;',
+                                  list(prices.items()), template='(%s, %s::integer)',
+                                  page_size=len(prices), fetch=True)
+            changed = [(url, today, price) for url, price in rows]
+            write_prices(cur, changed, self.history_mode)
+            update_current_prices(cur, changed)
+            record_checks(cur, list(prices), today)
+        return len(changed)
+
+    def updated(self, changed, prices):
+        if self.stats is not None and prices:
+            self.stats.inc_value('immo_crawl/card_prices/checked', len(prices))
+            self.stats.inc_value('immo_crawl/card_prices/changed', changed)
@@ -0,0 +1,69 @@
+import logging
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+from immo_crawl.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsExtension(object):
+    """
+    Records the download latency of each response and the dropped items of the spider in
+    the :class:`~immo_crawl.metrics.Metrics` of the crawler, which also contain the callback,
+    pipeline and database times (cf. :class:`~immo_crawl.middlewares.CallbackTimingMiddleware`,
+    :func:`~immo_crawl.pipelines.timed_stage` and
+    :class:`~immo_crawl.database.ConnectionPool`).
+
+    Every ``METRICS_INTERVAL`` seconds and when the spider is closed, a summary is logged and
+    the metrics are written to ``METRICS_FILE`` (cf. :meth:`~immo_crawl.metrics.Metrics.export`).
+
+    Attributes:
+        metrics (:class:`~immo_crawl.metrics.Metrics`): metrics of the crawler
+        interval (float): seconds between two exports
+        path (str): file to which the metrics are exported (``None`` to only log them)
+    """
+
+    def __init__(self, metrics, interval=60.0, path=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.path = path
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics = get_metrics(crawler)
+        if metrics is None:
+            raise NotConfigured
+        path = crawler.settings.get('METRICS_FILE')
+        extension = cls(metrics, interval=crawler.settings.getfloat('METRICS_INTERVAL', 60.0),
+                        path=path.format(spider=crawler.spidercls.name) if path else None)
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(extension.response_received, signal=signals.response_received)
+        crawler.signals.connect(extension.item_dropped, signal=signals.item_dropped)
+        return extension
+
+    def spider_opened(self, spider):
+        self.task = task.LoopingCall(self.report, spider)
+        self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task.running:
+            self.task.stop()
+        self.report(spider)
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.metrics.observe('download_latency', latency, canton=request.cb_kwargs.get('canton'))
+
+    def item_dropped(self, item, response, exception, spider):
+        self.metrics.inc('items_dropped', canton=item.get('canton'), reason=str(exception) or type(exception).__name__)
+
+    def report(self, spider):
+        spider.logger.info('Metrics: %s', self.metrics.summary())
+        if self.path:
+            try:
+                self.metrics.export(self.path)
+            except OSError as e:
+                logger.error('Metrics could not be written to %s: %s', self.path, e)
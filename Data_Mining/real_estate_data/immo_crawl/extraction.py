@@ -0,0 +1,167 @@
+import re
+import json
+from datetime import datetime
+from lxml import etree
+
+CARD_PRICE = re.compile(r'CHF\s*([\d’\']+)')
+
+
+def card_price(selector):
+    """
+    Returns the rent shown on the card of an advertisement on a results page, or ``None``
+    if the card shows no price (e.g. "Preis auf Anfrage").
+
+    Parameters:
+        selector (scrapy.selector.Selector): the card or the link to the advertisement
+    """
+    price = selector.css('::text').re_first(CARD_PRICE)
+    if not price:
+        return None
+    price = price.replace('’', '').replace("'", '')
+    return int(price) if price else None
+
+
+class XPathExtractor(object):
+    """
+    Extracts the fields of an advertisement with a fixed set of XPath expressions. The
+    expressions are compiled once, and an expression that is used for several fields is
+    evaluated only once per response. The results are passed to the input processors of
+    an :class:`~scrapy.loader.ItemLoader` in the same way as by ``add_xpath``.
+
+    Attributes:
+        fields (dict): XPath expression for each field of the item
+        xpaths (dict): compiled XPath for each distinct expression
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.xpaths = {expression: etree.XPath(expression, smart_strings=False)
+                       for expression in set(fields.values())}
+
+    def extract(self, response):
+        """
+        Evaluates each distinct expression on the response.
+
+        Parameters:
+            response (scrapy.http.Response): HTTP response of a detail page
+
+        Returns:
+            dict: list of the extracted strings for each field
+        """
+        root = response.selector.root
+        results = {expression: [str(value) for value in xpath(root)]
+                   for expression, xpath in self.xpaths.items()}
+        return {field: results[expression] for field, expression in self.fields.items()}
+
+    def load(self, loader, response):
+        """
+        Adds the extracted values of all fields to the loader.
+
+        Parameters:
+            loader (scrapy.loader.ItemLoader): loader to which the values are added
+            response (scrapy.http.Response): HTTP response of a detail page
+        """
+        for field, values in self.extract(response).items():
+            loader.add_value(field, values)
+
+
+def number_text(value):
+    """
+    Returns a number of the embedded JSON as it is shown on the page (``3.5``, ``2``).
+    """
+    return '{:g}'.format(value)
+
+
+def decimal_comma(value):
+    """
+    Returns a number of the embedded JSON with a decimal comma (``3,5``), cf. :func:`~immo_crawl.items.replace_point`.
+    """
+    return number_text(value).replace('.', ',')
+
+
+def iso_date(value):
+    """
+    Returns a date of the format ``yyyy-mm-dd`` as datetime, in the same way as 
+    :func:`~immo_crawl.pipelines.to_date` converts the dates shown on the page.
+    """
+    year, month, day = value[:10].split('-')
+    return datetime(int(year), int(month), int(day))
+
+
+class EmbeddedJsonExtractor(object):
+    """
+    Extracts the fields of an advertisement from the listing data that a detail page embeds 
+    as JSON state (e.g. ``window.__INITIAL_STATE__ = {...}``). The state is found with a byte 
+    search in the body, and only the state is decoded and parsed, so that the HTML is not 
+    parsed at all. The values are converted to the types that the pipelines store, instead 
+    of cleaning the rendered strings.
+
+    If a page has no state, no listing data in it, or one of the required fields is missing 
+    (e.g. after a key was renamed), :meth:`extract` returns ``None`` and the fields have to 
+    be extracted from the HTML (cf. :class:`XPathExtractor`).
+
+    Attributes:
+        marker (bytes): name of the variable to which the state is assigned
+        root (tuple): keys of the listing data in the state
+        fields (dict): keys of the value in the listing data and conversion for each field
+        required (tuple): fields without which the listing data is not used
+    """
+
+    def __init__(self, marker, root, fields, required=()):
+        self.marker = marker
+        self.root = root
+        self.fields = fields
+        self.required = required
+        self.decoder = json.JSONDecoder()
+
+    def state(self, response):
+        """
+        Returns the parsed JSON state of the response, or ``None`` if it has none.
+        """
+        body = response.body
+        start = body.find(self.marker)
+        if start < 0:
+            return None
+        start = body.find(b'{', start + len(self.marker))
+        end = body.find(b'</script>', start)
+        if start < 0 or end < 0:
+            return None
+        try:
+            state, _ = self.decoder.raw_decode(body[start:end].decode(response.encoding))
+        except (ValueError, UnicodeDecodeError):
+            return None
+        return state
+
+    @staticmethod
+    def lookup(data, keys):
+        for key in keys:
+            if not isinstance(data, dict):
+                return None
+            data = data.get(key)
+        return data
+
+    def extract(self, response):
+        """
+        Extracts the fields from the JSON state of the response. Fields without value are left out.
+
+        Parameters:
+            response (scrapy.http.Response): HTTP response of a detail page
+
+        Returns:
+            dict: value of each field, or ``None`` if the page has no listing data or a required field is missing
+        """
+        listing = self.lookup(self.state(response), self.root)
+        if not isinstance(listing, dict):
+            return None
+        fields = {}
+        for field, (keys, convert) in self.fields.items():
+            value = self.lookup(listing, keys)
+            if value is None or value == '':
+                continue
+            try:
+                fields[field] = convert(value)
+            except (TypeError, ValueError):
+                continue
+        if not all(field in fields for field in self.required):
+            return None
+        return fields
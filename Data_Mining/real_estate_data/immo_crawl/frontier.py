@@ -0,0 +1,92 @@
+import json
+import sqlite3
+from pathlib import Path
+
+PENDING = 0
+DONE = 1
+
+
+class CrawlFrontier(object):
+    """
+    On-disk record of the requests of a crawl, stored in a SQLite database. Each request
+    is either pending (scheduled, but its response was not processed yet) or done. If a run
+    is interrupted, the pending requests are sent again by the next run, while done pages
+    are not requested again.
+
+    Attributes:
+        path (pathlib.Path): file of the SQLite database
+        commit_every (int): number of changes after which they are written to disk
+    """
+
+    def __init__(self, path, commit_every=500):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.commit_every = commit_every
+        self.changes = 0
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS frontier ('
+                          'url TEXT PRIMARY KEY, callback TEXT, cb_kwargs TEXT, canton TEXT, '
+                          'state INTEGER) WITHOUT ROWID;')
+
+    def add(self, url, callback, cb_kwargs):
+        """
+        Records a scheduled request as pending.
+
+        Parameters:
+            url (str): URL of the request
+            callback (str): name of the spider method that processes the response
+            cb_kwargs (dict): keyword arguments of the callback
+
+        Returns:
+            bool: ``False`` if the URL is already pending or done
+        """
+        cb_kwargs = cb_kwargs or {}
+        cursor = self.conn.execute(
+            'INSERT OR IGNORE INTO frontier (url, callback, cb_kwargs, canton, state) VALUES (?, ?, ?, ?, ?);',
+            (url, callback, json.dumps(cb_kwargs) if cb_kwargs else None, cb_kwargs.get('canton'), PENDING))
+        self.changed()
+        return cursor.rowcount == 1
+
+    def done(self, url):
+        """
+        Marks a request as done after its response was processed.
+        """
+        self.conn.execute('UPDATE frontier SET state = ? WHERE url = ?;', (DONE, url))
+        self.changed()
+
+    def pending(self):
+        """
+        Yields ``(url, callback, cb_kwargs)`` for all pending requests.
+        """
+        for url, callback, cb_kwargs in self.conn.execute(
+                'SELECT url, callback, cb_kwargs FROM frontier WHERE state = ?;', (PENDING, )).fetchall():
+            yield url, callback, json.loads(cb_kwargs) if cb_kwargs else {}
+
+    def summary(self):
+        """
+        Returns the number of pending and done requests per callback and canton.
+        """
+        return self.conn.execute('SELECT callback, canton, state, count(*) FROM frontier '
+                                 'GROUP BY callback, canton, state;').fetchall()
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.changes = 0
+
+    def clear(self):
+        """
+        Removes all requests, e.g. after a run has finished.
+        """
+        self.conn.execute('DELETE FROM frontier;')
+        self.commit()
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,50 @@
+import sqlite3
+from pathlib import Path
+
+
+class ValidatorCache(object):
+    """
+    Stores the validators of the last response for each URL in a SQLite database:
+    the ``ETag`` and ``Last-Modified`` headers and a fingerprint of the content.
+    The response bodies themselves are not stored.
+
+    Attributes:
+        path (pathlib.Path): file of the SQLite database
+        commit_every (int): number of changes after which they are written to disk
+    """
+
+    def __init__(self, path, commit_every=500):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.commit_every = commit_every
+        self.changes = 0
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS validators ('
+                          'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, fingerprint TEXT) WITHOUT ROWID;')
+
+    def get(self, url):
+        """
+        Returns ``(etag, last_modified, fingerprint)`` of the last response of a URL or ``None``.
+        """
+        return self.conn.execute('SELECT etag, last_modified, fingerprint FROM validators WHERE url = ?;',
+                                 (url, )).fetchone()
+
+    def put(self, url, etag, last_modified, fingerprint):
+        """
+        Stores the validators of a response.
+        """
+        self.conn.execute('INSERT OR REPLACE INTO validators (url, etag, last_modified, fingerprint) '
+                          'VALUES (?, ?, ?, ?);', (url, etag, last_modified, fingerprint))
+        self.changes += 1
+        if self.changes >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.changes = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
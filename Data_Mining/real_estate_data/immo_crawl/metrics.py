@@ -0,0 +1,198 @@
+import json
+import os
+import bisect
+import threading
+from pathlib import Path
+
+# Upper bounds (in seconds) of the histogram buckets, the last bucket is unbounded
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """
+    Distribution of observed durations in the fixed :data:`BUCKETS`.
+
+    Attributes:
+        counts (list): number of observations per bucket (not cumulative)
+        count (int): number of observations
+        sum (float): sum of the observations
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def quantile(self, fraction):
+        """
+        Returns the upper bound of the bucket that contains the quantile ``fraction``.
+        """
+        rank = fraction * self.count
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'), ), self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def cumulative(self):
+        """
+        Returns ``(upper bound, cumulative count)`` for each bucket.
+        """
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'), ), self.counts):
+            cumulative += count
+            yield bound, cumulative
+
+
+class Metrics(object):
+    """
+    Histograms and counters of a crawler, each with a name and a set of labels
+    (e.g. ``canton``). The name of the spider is added as label when the metrics are
+    exported. Observations are recorded under a lock, since the database operations
+    are recorded from the threads of the connection pool.
+
+    Attributes:
+        spider (str): name of the spider
+        histograms (dict): :class:`Histogram` for each name and labels
+        counters (dict): value for each name and labels
+    """
+
+    def __init__(self, spider):
+        self.spider = spider
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        """
+        Returns the key of a metric. Labels without value (e.g. the canton of a pricecheck) are left out.
+        """
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items() if value is not None))
+
+    def observe(self, name, value, **labels):
+        """
+        Adds a duration in seconds to the histogram ``name``.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name, count=1, **labels):
+        """
+        Increments the counter ``name``.
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + count
+
+    def totals(self):
+        """
+        Returns the histograms summed over all labels.
+        """
+        totals = {}
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                totals.setdefault(name, Histogram()).merge(histogram)
+        return totals
+
+    def summary(self):
+        """
+        Returns a single line with the count, mean and 95th percentile of each histogram
+        and the number of dropped items.
+        """
+        parts = []
+        for name, histogram in sorted(self.totals().items()):
+            if histogram.count:
+                parts.append('{} n={} mean={:.4f}s p95<={}s'.format(
+                    name, histogram.count, histogram.sum / histogram.count, histogram.quantile(0.95)))
+        with self.lock:
+            dropped = sum(count for (name, labels), count in self.counters.items() if name == 'items_dropped')
+        parts.append('items_dropped={}'.format(dropped))
+        return ', '.join(parts)
+
+    def labels(self, labels, **extra):
+        labels = (('spider', self.spider), ) + labels + tuple(extra.items())
+        return ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, value in labels)
+
+    def to_prometheus(self):
+        """
+        Returns the metrics in the text format of Prometheus.
+        """
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for name in sorted({name for (name, labels), histogram in histograms}):
+            lines.append('# TYPE immo_crawl_{}_seconds histogram'.format(name))
+            for (metric, labels), histogram in histograms:
+                if metric != name:
+                    continue
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('immo_crawl_{}_seconds_bucket{{{}}} {}'.format(name, self.labels(labels, le=le), count))
+                lines.append('immo_crawl_{}_seconds_sum{{{}}} {}'.format(name, self.labels(labels), histogram.sum))
+                lines.append('immo_crawl_{}_seconds_count{{{}}} {}'.format(name, self.labels(labels), histogram.count))
+        for name in sorted({name for (name, labels), count in counters}):
+            lines.append('# TYPE immo_crawl_{}_total counter'.format(name))
+            for (metric, labels), count in counters:
+                if metric == name:
+                    lines.append('immo_crawl_{}_total{{{}}} {}'.format(name, self.labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self):
+        """
+        Returns the metrics as JSON document.
+        """
+        with self.lock:
+            histograms = [{'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                           'buckets': [['+Inf' if bound == float('inf') else bound, count]
+                                       for bound, count in histogram.cumulative()]}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': count}
+                        for (name, labels), count in sorted(self.counters.items())]
+        return json.dumps({'spider': self.spider, 'histograms': histograms, 'counters': counters}, indent=1)
+
+    def export(self, path):
+        """
+        Writes the metrics to ``path``, as JSON if the file name ends with ``.json`` and in
+        the text format of Prometheus otherwise. The file is replaced atomically, so that a
+        collector never reads a partially written file.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        content = self.to_json() if path.suffix == '.json' else self.to_prometheus()
+        temporary = path.with_name(path.name + '.tmp')
+        temporary.write_text(content, encoding='utf-8')
+        os.replace(str(temporary), str(path))
+
+
+def get_metrics(crawler):
+    """
+    Returns the :class:`Metrics` of the crawler, or ``None`` if ``METRICS_ENABLED`` is not set.
+
+    Parameters:
+        crawler (scrapy.crawler.Crawler): the running crawler
+    """
+    if not crawler.settings.getbool('METRICS_ENABLED'):
+        return None
+    metrics = getattr(crawler, 'metrics', None)
+    if metrics is None:
+        metrics = crawler.metrics = Metrics(crawler.spidercls.name)
+    return metrics
@@ -3,11 +3,25 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+import logging
+import hashlib
+from pathlib import Path
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import Request
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from immo_crawl.frontier import CrawlFrontier
+from immo_crawl.httpcache import ValidatorCache
+from immo_crawl.metrics import get_metrics
+from immo_crawl.signals import item_buffered, items_written
+from immo_crawl.throttling import DomainController, THROTTLE_STATUSES
+
+logger = logging.getLogger(__name__)
+
 
 class ImmoCrawlSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +115,436 @@ class ImmoCrawlDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class FrontierMiddleware:
+    """
+    Records the requests of a crawl in a :class:`~immo_crawl.frontier.CrawlFrontier`, so that
+    an interrupted run can be resumed. At the start of a run, the requests that were still
+    pending are sent again and start URLs that were already processed are skipped. The
+    frontier is cleared when a run has finished.
+
+    A request is done when its response has been processed and all items of the response
+    have left the item pipelines. Items that :class:`~immo_crawl.pipelines.WriteToDB` buffers
+    are only done when they have been written (cf. :mod:`immo_crawl.signals`), so that the
+    ads of a run that is killed before the next flush are requested again. A request is also
+    done when it was dropped (e.g. by the duplicate filter), its download failed or its
+    callback raised an error, so that it is not sent again by every resumed run.
+
+    Enabled by setting ``FRONTIER_DIR``, the directory in which one frontier per spider is stored.
+    """
+
+    def __init__(self, directory, commit_every):
+        self.directory = Path(directory)
+        self.commit_every = commit_every
+        # Unfinished items (and the callback itself) per URL, and URL of each unfinished item
+        self.outstanding = {}
+        self.item_urls = {}
+        self.buffered = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        directory = crawler.settings.get('FRONTIER_DIR')
+        if not directory:
+            raise NotConfigured
+        s = cls(directory, crawler.settings.getint('FRONTIER_COMMIT_EVERY', 500))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.request_dropped, signal=signals.request_dropped)
+        crawler.signals.connect(s.spider_error, signal=signals.spider_error)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(s.item_error, signal=signals.item_error)
+        crawler.signals.connect(s.item_buffered, signal=item_buffered)
+        crawler.signals.connect(s.items_written, signal=items_written)
+        return s
+
+    def spider_opened(self, spider):
+        self.frontier = CrawlFrontier(self.directory / '{}.sqlite'.format(spider.name), self.commit_every)
+
+    def spider_closed(self, spider, reason):
+        if reason == 'finished':
+            self.frontier.clear()
+        else:
+            for callback, canton, state, count in self.frontier.summary():
+                spider.logger.info('Frontier: %d %s requests for %s (%s)', count,
+                                   'done' if state else 'pending', callback, canton or '-')
+        self.frontier.close()
+
+    def process_start_requests(self, start_requests, spider):
+        pending = list(self.frontier.pending())
+        if pending:
+            spider.logger.info('Resuming %d pending requests from %s', len(pending), self.frontier.path)
+        else:
+            self.frontier.clear()
+
+        # Start URLs that are already pending or done are not sent again
+        for request in start_requests:
+            if self.add(request):
+                yield self.track(request)
+        for url, callback, cb_kwargs in pending:
+            yield self.track(Request(url, callback=getattr(spider, callback), cb_kwargs=cb_kwargs))
+
+    def process_spider_output(self, response, result, spider):
+        url = self.url(response.request)
+        self.outstanding[url] = self.outstanding.get(url, 0) + 1
+        try:
+            for i in result:
+                if isinstance(i, Request):
+                    if not self.add(i):
+                        continue
+                    i = self.track(i)
+                elif is_item(i):
+                    self.outstanding[url] += 1
+                    self.item_urls[id(i)] = url
+                yield i
+        finally:
+            self.callback_done(response.request)
+
+    def add(self, request):
+        callback = request.callback.__name__ if request.callback else 'parse'
+        return self.frontier.add(request.url, callback, request.cb_kwargs)
+
+    @staticmethod
+    def url(request):
+        # A redirected request is recorded under its original URL
+        return request.meta.get('redirect_urls', [request.url])[0]
+
+    def done(self, request):
+        self.frontier.done(self.url(request))
+
+    def release(self, url):
+        """
+        Marks the request of the URL as done once its callback and all its items have finished.
+        """
+        count = self.outstanding.pop(url, 1) - 1
+        if count > 0:
+            self.outstanding[url] = count
+        else:
+            self.frontier.done(url)
+
+    def callback_done(self, request):
+        # Either the end of the callback output or spider_error, whichever comes first
+        if request.meta.get('frontier_callback_done'):
+            return
+        request.meta['frontier_callback_done'] = True
+        self.release(self.url(request))
+
+    def item_done(self, item):
+        url = self.item_urls.pop(id(item), None)
+        if url is not None:
+            self.release(url)
+
+    def track(self, request):
+        """
+        Returns the request with an errback that marks it as done when its download fails,
+        before the errback of the spider (if any) is called.
+        """
+        errback = request.errback
+
+        def failed(failure):
+            self.done(getattr(failure, 'request', request))
+            return errback(failure) if errback else failure
+        return request.replace(errback=failed)
+
+    def request_dropped(self, request, spider):
+        self.done(request)
+
+    def spider_error(self, failure, response, spider):
+        self.callback_done(response.request)
+
+    def item_scraped(self, item, response, spider):
+        if id(item) not in self.buffered:
+            self.item_done(item)
+
+    def item_dropped(self, item, response, exception, spider):
+        self.item_done(item)
+
+    def item_error(self, item, response, spider, failure):
+        if id(item) not in self.buffered:
+            self.item_done(item)
+
+    def item_buffered(self, item, spider):
+        self.buffered.add(id(item))
+
+    def items_written(self, items, spider):
+        for item in items:
+            self.buffered.discard(id(item))
+            self.item_done(item)
+
+
+class CallbackTimingMiddleware:
+    """
+    Records the CPU time of the spider callbacks per callback and canton in the
+    :class:`~immo_crawl.metrics.Metrics` of the crawler. Only the time in which the
+    callback is running in this thread is counted, not the time the engine needs to
+    process its output or the time spent in other threads and processes.
+
+    Enabled by ``METRICS_ENABLED``. The middleware must be the closest one to the spider.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        metrics = get_metrics(crawler)
+        if metrics is None:
+            raise NotConfigured
+        return cls(metrics)
+
+    def process_spider_output(self, response, result, spider):
+        request = response.request
+        callback = request.callback or spider.parse
+        elapsed = 0.0
+        result = iter(result)
+        while True:
+            start = time.thread_time()
+            try:
+                output = next(result)
+            except StopIteration:
+                elapsed += time.thread_time() - start
+                break
+            elapsed += time.thread_time() - start
+            yield output
+        self.metrics.observe('callback_cpu', elapsed, callback=getattr(callback, '__name__', 'parse'),
+                             canton=request.cb_kwargs.get('canton'))
+
+
+class ConditionalRequestMiddleware:
+    """
+    Sends conditional requests for URLs that were requested before, using the ``ETag`` and 
+    ``Last-Modified`` headers stored in a :class:`~immo_crawl.httpcache.ValidatorCache`. Responses 
+    that were not modified (status 304) or whose content fingerprint did not change are dropped 
+    with :class:`~scrapy.exceptions.IgnoreRequest`, so that they are not parsed.
+
+    The validators of a changed response are only stored once its item has been scraped, i.e. 
+    after the price was written (or found to be stored already), so that a page whose item 
+    failed is requested in full again by the next run. Requests of Scrapy itself, e.g. for 
+    ``robots.txt``, are passed on unchanged.
+
+    The fingerprint is calculated from the text selected by the ``fingerprint_xpath`` attribute 
+    of the spider, or from the whole body if the spider has no such attribute.
+
+    Enabled by setting ``CONDITIONAL_CACHE_PATH``, the file in which the validators are stored.
+    """
+
+    def __init__(self, path, stats):
+        self.path = path
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('CONDITIONAL_CACHE_PATH')
+        if not path:
+            raise NotConfigured
+        s = cls(path, crawler.stats)
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(s.item_dropped, signal=signals.item_dropped)
+        return s
+
+    def spider_opened(self, spider):
+        self.cache = ValidatorCache(self.path)
+
+    def spider_closed(self, spider):
+        self.cache.close()
+
+    @staticmethod
+    def applies(request):
+        """
+        Returns whether the request is sent conditionally, which is not the case for the 
+        requests of ``robots.txt``: if they were dropped, Scrapy would allow every URL.
+        """
+        return not request.meta.get('dont_obey_robotstxt') and not request.url.endswith('/robots.txt')
+
+    def process_request(self, request, spider):
+        if not self.applies(request):
+            return None
+        validators = self.cache.get(request.url)
+        if validators:
+            etag, last_modified, fingerprint = validators
+            if etag:
+                request.headers.setdefault('If-None-Match', etag)
+            if last_modified:
+                request.headers.setdefault('If-Modified-Since', last_modified)
+        return None
+
+    def process_response(self, request, response, spider):
+        if not self.applies(request):
+            return response
+        if response.status == 304:
+            self.stats.inc_value('immo_crawl/conditional/not_modified', spider=spider)
+            raise IgnoreRequest('Not modified: {}'.format(request.url))
+        if response.status != 200:
+            return response
+
+        fingerprint = self.fingerprint(response, spider)
+        validators = self.cache.get(request.url)
+        etag, last_modified = self.header(response, 'ETag'), self.header(response, 'Last-Modified')
+        if validators and validators[2] == fingerprint:
+            # The content whose item was scraped before, only the headers may have changed
+            self.cache.put(request.url, etag, last_modified, fingerprint)
+            self.stats.inc_value('immo_crawl/conditional/unchanged', spider=spider)
+            raise IgnoreRequest('Content unchanged: {}'.format(request.url))
+        self.stats.inc_value('immo_crawl/conditional/changed', spider=spider)
+        request.meta['conditional_validators'] = (request.url, etag, last_modified, fingerprint)
+        return response
+
+    def item_scraped(self, item, response, spider):
+        """
+        Stores the validators of the response once its item has passed all pipelines.
+        """
+        validators = response.meta.get('conditional_validators')
+        if validators:
+            self.cache.put(*validators)
+
+    def item_dropped(self, item, response, exception, spider):
+        """
+        A price that is dropped because it equals the stored price (cf. 
+        :class:`~immo_crawl.pipelines.ComparePrice`) needs not to be requested again either.
+        """
+        if getattr(exception, 'reason', None) == 'price_unchanged':
+            self.item_scraped(item, response, spider)
+
+    @staticmethod
+    def header(response, name):
+        value = response.headers.get(name)
+        return value.decode('latin-1') if value else None
+
+    @staticmethod
+    def fingerprint(response, spider):
+        xpath = getattr(spider, 'fingerprint_xpath', None)
+        if xpath and hasattr(response, 'xpath'):
+            content = ''.join(response.xpath(xpath).getall()).encode('utf-8')
+        else:
+            content = response.body
+        return hashlib.sha1(content).hexdigest()
+
+
+class AdaptiveConcurrencyMiddleware:
+    """
+    Adjusts the concurrency and the download delay of each domain (download slot) with the 
+    AIMD policy of :class:`~immo_crawl.throttling.DomainController`, from the download latency 
+    and the throttled (429, 503) and failed responses of the domain. Each domain starts with 
+    ``CONCURRENT_REQUESTS_PER_DOMAIN`` and ``DOWNLOAD_DELAY`` and is kept within the limits 
+    ``ADAPTIVE_CONCURRENCY_MIN``/``_MAX`` and ``ADAPTIVE_DELAY_MIN``/``_MAX``, which can be 
+    overridden per domain in ``ADAPTIVE_DOMAIN_LIMITS``. By default the maximum concurrency and
+    the minimum delay are the configured ones, so that a domain is only slowed down; the
+    settings of the project raise them for the portals.
+
+    Every change is counted in the stats (``immo_crawl/adaptive/<domain>/increase`` and 
+    ``/decrease``) together with the resulting concurrency and delay. The middleware must 
+    be closer to the downloader than the ``RetryMiddleware``, so that it sees the throttled 
+    responses before they are retried.
+
+    Enabled by ``ADAPTIVE_CONCURRENCY_ENABLED``. It replaces AutoThrottle, since both set the 
+    delay of the download slots.
+    """
+
+    def __init__(self, crawler, limits, domain_limits=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.limits = limits
+        self.domain_limits = domain_limits or {}
+        self.controllers = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        if settings.getbool('AUTOTHROTTLE_ENABLED'):
+            logger.warning('AutoThrottle and AdaptiveConcurrencyMiddleware are both enabled and set the same delays')
+        limits = {
+            'min_concurrency': settings.getint('ADAPTIVE_CONCURRENCY_MIN', 1),
+            'max_concurrency': settings.getint('ADAPTIVE_CONCURRENCY_MAX',
+                                               settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')),
+            'min_delay': settings.getfloat('ADAPTIVE_DELAY_MIN', settings.getfloat('DOWNLOAD_DELAY')),
+            'max_delay': settings.getfloat('ADAPTIVE_DELAY_MAX', 60.0),
+            'rate_step': settings.getfloat('ADAPTIVE_RATE_STEP', 0.25),
+            'target_latency': settings.getfloat('ADAPTIVE_TARGET_LATENCY', 2.0),
+            'backoff': settings.getfloat('ADAPTIVE_BACKOFF', 0.5),
+        }
+        s = cls(crawler, limits, settings.getdict('ADAPTIVE_DOMAIN_LIMITS'))
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        request.meta['adaptive_sent_at'] = time.monotonic()
+        return None
+
+    def process_response(self, request, response, spider):
+        throttled = response.status in THROTTLE_STATUSES
+        self.record(request, spider, latency=request.meta.get('download_latency'), throttled=throttled,
+                    error=response.status >= 500 and not throttled,
+                    retry_after=self.retry_after(response) if throttled else None)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if not isinstance(exception, IgnoreRequest):
+            self.record(request, spider, error=True)
+        return None
+
+    @staticmethod
+    def retry_after(response):
+        value = response.headers.get('Retry-After')
+        try:
+            return float(value) if value else None
+        except ValueError:
+            # An HTTP date instead of seconds
+            return None
+
+    def controller(self, key, slot):
+        """
+        Returns the controller of a download slot. A new controller starts from the current 
+        concurrency and delay of the slot, within the limits of its domain.
+        """
+        controller = self.controllers.get(key)
+        if controller is None:
+            limits = dict(self.limits)
+            for domain, overrides in self.domain_limits.items():
+                if key == domain or key.endswith('.' + domain):
+                    limits.update(overrides)
+            controller = self.controllers[key] = DomainController(slot.concurrency, slot.delay, **limits)
+            self.apply(key, slot, controller)
+        return controller
+
+    def record(self, request, spider, latency=None, throttled=False, error=False, retry_after=None):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+        controller = self.controller(key, slot)
+        prefix = 'immo_crawl/adaptive/{}/'.format(key)
+        self.stats.inc_value(prefix + 'responses', spider=spider)
+        if throttled:
+            self.stats.inc_value(prefix + 'throttled', spider=spider)
+        if error:
+            self.stats.inc_value(prefix + 'errors', spider=spider)
+        decision = controller.response(request.meta.get('adaptive_sent_at', 0.0), latency=latency,
+                                       throttled=throttled, error=error, retry_after=retry_after)
+        if decision is None:
+            return
+        self.stats.inc_value(prefix + decision, spider=spider)
+        self.apply(key, slot, controller)
+        logger.debug('%s %s: concurrency %d, delay %.2fs (latency %.2fs, errors %.0f%%, throttled %.0f%%)',
+                     decision.capitalize(), key, controller.concurrency, controller.delay,
+                     controller.latency or 0.0, 100 * controller.error_rate, 100 * controller.throttle_rate)
+
+    def apply(self, key, slot, controller):
+        slot.concurrency = controller.concurrency
+        slot.delay = controller.delay
+        prefix = 'immo_crawl/adaptive/{}/'.format(key)
+        self.stats.set_value(prefix + 'concurrency', controller.concurrency)
+        self.stats.set_value(prefix + 'delay', round(controller.delay, 3))
+        self.stats.max_value(prefix + 'max_concurrency', controller.concurrency)
+
+    def spider_closed(self, spider):
+        for key, controller in self.controllers.items():
+            prefix = 'immo_crawl/adaptive/{}/'.format(key)
+            if controller.latency is not None:
+                self.stats.set_value(prefix + 'latency', round(controller.latency, 3), spider=spider)
+            self.stats.set_value(prefix + 'error_rate', round(controller.error_rate, 3), spider=spider)
+            self.stats.set_value(prefix + 'throttle_rate', round(controller.throttle_rate, 3), spider=spider)
@@ -0,0 +1,90 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from scrapy import signals
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.misc import load_object
+from twisted.internet import defer, reactor
+
+
+def parse_in_worker(spider_path, url, request_url, body, encoding, kwargs):
+    """
+    Runs the extraction of a detail page in a worker process. The response is rebuilt
+    from its body and passed to the ``build_item`` method of the spider class.
+
+    Parameters:
+        spider_path (str): import path of the spider class
+        url (str): URL of the response
+        request_url (str): URL of the request that was sent
+        body (bytes): body of the response
+        encoding (str): encoding of the response
+        kwargs (dict): further arguments of ``build_item``
+
+    Returns:
+        dict: the fields of the extracted item
+    """
+    response = HtmlResponse(url, body=body, encoding=encoding, request=Request(request_url))
+    return dict(load_object(spider_path).build_item(response, **kwargs))
+
+
+class ParserPool(object):
+    """
+    Pool of worker processes that extract the items from the detail pages, so that the
+    CPU-bound parsing is spread across several cores instead of running in the reactor process.
+
+    Attributes:
+        executor (concurrent.futures.ProcessPoolExecutor): the worker processes
+    """
+
+    def __init__(self, processes):
+        self.executor = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+
+    def parse(self, spider, response, **kwargs):
+        """
+        Sends a response to a worker process.
+
+        Parameters:
+            spider (scrapy.Spider): spider whose ``build_item`` is used for the extraction
+            response (scrapy.http.Response): HTTP response of a detail page
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with the fields of the extracted item
+        """
+        spider_path = '{}.{}'.format(type(spider).__module__, type(spider).__name__)
+        future = self.executor.submit(parse_in_worker, spider_path, response.url, response.request.url,
+                                      response.body, response.encoding, kwargs)
+        d = defer.Deferred()
+        future.add_done_callback(lambda future: reactor.callFromThread(self.fire, d, future))
+        return d
+
+    @staticmethod
+    def fire(d, future):
+        try:
+            result = future.result()
+        except Exception as error:
+            d.errback(error)
+        else:
+            d.callback(result)
+
+    def close(self):
+        """
+        Shuts down the worker processes.
+        """
+        self.executor.shutdown(wait=False)
+
+
+def get_parser_pool(crawler):
+    """
+    Returns the :class:`ParserPool` of the crawler, or ``None`` if ``PARSER_PROCESSES`` is 0.
+    The pool is created on first use and shut down when the engine is stopped.
+
+    Parameters:
+        crawler (scrapy.crawler.Crawler): the running crawler
+    """
+    processes = crawler.settings.getint('PARSER_PROCESSES', 0)
+    if processes <= 0:
+        return None
+    pool = getattr(crawler, 'parser_pool', None)
+    if pool is None:
+        pool = crawler.parser_pool = ParserPool(processes)
+        crawler.signals.connect(pool.close, signal=signals.engine_stopped)
+    return pool
@@ -1,122 +1,367 @@
+import time
+import functools
 import psycopg2
+from psycopg2.extras import execute_values
 from scrapy.exceptions import DropItem
+from twisted.internet import defer, task
 from datetime import datetime
-from immo_crawl.credentials import HOSTNAME, USERNAME, PASSWORD, DATABASE
+from immo_crawl.database import get_pool
+from immo_crawl.duplicates import DuplicateIndex
+from immo_crawl.history import update_current_prices, write_prices
+from immo_crawl.metrics import get_metrics
+from immo_crawl.signals import item_buffered, items_written
+
+
+def timed_stage(process_item):
+    """
+    Decorator of the ``process_item`` methods of the pipelines, which records the time the
+    stage needs per item in the :class:`~immo_crawl.metrics.Metrics` of the crawler. If the
+    stage returns a Deferred, e.g. :class:`WriteToDB`, the time until the Deferred fires is
+    recorded. Without ``METRICS_ENABLED`` the method is only called.
+    """
+    @functools.wraps(process_item)
+    def process_timed(self, item, spider):
+        metrics = get_metrics(spider.crawler)
+        if metrics is None:
+            return process_item(self, item, spider)
+        start = time.perf_counter()
+
+        def record(result):
+            metrics.observe('pipeline_stage', time.perf_counter() - start, stage=type(self).__name__,
+                            canton=item.get('canton'))
+            return result
+
+        try:
+            result = process_item(self, item, spider)
+        except Exception:
+            record(None)
+            raise
+        if isinstance(result, defer.Deferred):
+            return result.addBoth(record)
+        return record(result)
+    return process_timed
 
 
 class WriteToDB(object):
     """
     Write the data from :class:`~immo_crawl.items.ImmoCrawlItem` to the database.
+
+    The items are collected in a buffer and written with multi-row INSERTs as soon as
+    ``DB_BUFFER_SIZE`` items are buffered, every ``DB_FLUSH_INTERVAL`` seconds and when
+    the spider is closed. If the database cannot be reached, the batch is kept in the buffer
+    and written again with the next periodic flush; only the items that are still buffered
+    when the spider is closed are counted as failed.
+
+    Attributes:
+        pool (:class:`~immo_crawl.database.ConnectionPool`): pool from which the connections are taken
+        buffer_size (int): number of buffered items that triggers a write
+        flush_interval (float): seconds after which the buffer is written regardless of its size
+        history_mode (str): storage mode of the price history (cf. :func:`~immo_crawl.history.write_prices`)
+        unavailable (bool): whether the last write failed because the database could not be reached
     """
 
+    def __init__(self, pool, buffer_size=500, flush_interval=30.0, history_mode='points'):
+        self.pool = pool
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.history_mode = history_mode
+        self.buffer = []
+        self.unavailable = False
+        self.closing = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(get_pool(crawler),
+                   buffer_size=crawler.settings.getint('DB_BUFFER_SIZE', 500),
+                   flush_interval=crawler.settings.getfloat('DB_FLUSH_INTERVAL', 30.0),
+                   history_mode=crawler.settings.get('PRICE_HISTORY_MODE', 'points'))
+
     def open_spider(self, spider):
         """
-        A connection to the database is established when the spider is started.
+        The periodic flush of the buffer is scheduled when the spider is started.
         """
-        self.conn = psycopg2.connect(
-            host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
-        self.cur = self.conn.cursor()
+        self.pending = set()
+        self.flush_task = task.LoopingCall(self.flush, spider)
+        self.flush_task.start(self.flush_interval, now=False)
 
     def close_spider(self, spider):
         """
-        When the spider has finished its run, the database connection that was established 
-        at the start (:meth:`open_spider`) is closed again.
-        """
-        self.cur.close()
-        self.conn.close()
+        When the spider has finished its run, the remaining items are written, including
+        those of running writes that are put back into the buffer.
 
+        Returns:
+            twisted.internet.defer.Deferred: fires when all writes have finished
+        """
+        if self.flush_task.running:
+            self.flush_task.stop()
+        d = defer.DeferredList(list(self.pending))
+        d.addCallback(lambda _: setattr(self, 'closing', True))
+        d.addCallback(lambda _: self.flush(spider))
+        return d
+
+    @timed_stage
     def process_item(self, item, spider):
         """
-        All data from each :class:`~immo_crawl.items.ImmoCrawlItem` is written to 
-        the main table of the database. The URL, the date and the price are also 
-        written are also written to the price table.
-        """
-        self.cur.execute('INSERT INTO eva_data (address, zip, city, canton, price_chf, '
-                         'rooms, area_m2, floor, utilities_chf, date_available, date_scraped, date_last_seen, url) '
-                         'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);',
-                         (item['address'], item['zip_code'], item['city'], item['canton'],
-                          item['price_chf'], item['rooms'], item['area_m2'], item['floor'],
-                          item['utilities_chf'], item['date_available'], item['date_scraped'],
-                          item['date_last_seen'], item['url']))
-        self.cur.execute('INSERT INTO eva_prices (url, date, price_chf) VALUES (%s, %s, %s);',
-                         (item['url'], item['date_scraped'], item['price_chf']))
-        self.conn.commit()
-        return item
+        All data from each :class:`~immo_crawl.items.ImmoCrawlItem` is added to the buffer, 
+        which is written to the main table and to the price table of the database by :meth:`flush`.
+        While the write queue of the pool is full, the item is held back, so that Scrapy pauses 
+        the intake of new items. While the database cannot be reached, the buffer is only 
+        written by the periodic flush.
+        """
+        self.buffer.append(item)
+        spider.crawler.signals.send_catch_log(signal=item_buffered, item=item, spider=spider)
+        if len(self.buffer) >= self.buffer_size and not self.unavailable:
+            d = self.flush(spider)
+        else:
+            d = self.pool.wait_for_capacity()
+        return d.addCallback(lambda _: item)
+
+    def flush(self, spider):
+        """
+        Writes all buffered items to the database in the thread pool of :attr:`pool`.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when the items have been written
+        """
+        if not self.buffer:
+            return defer.succeed(None)
+        items, self.buffer = self.buffer, []
+        d = self.pool.defer(self.write_batch, items)
+        d.addCallback(self.batch_written, spider)
+        d.addErrback(self.batch_failed, items, spider)
+        self.pending.add(d)
+        d.addBoth(lambda _: self.pending.discard(d))
+        return d
+
+    def write_batch(self, items):
+        """
+        Writes a batch of items in a single transaction. If the transaction fails, the batch 
+        is split in half and both halves are written separately, so that a single faulty item 
+        does not prevent the other items from being saved. If the database cannot be reached 
+        (:class:`psycopg2.OperationalError`), the batch is not split but the error is raised, 
+        so that the batch is written again later (cf. :meth:`batch_failed`).
+
+        The items are upserted on the unique URL (cf. :mod:`immo_crawl.schema`): an ad that is 
+        already stored, e.g. by an overlapping run, only gets its ``date_last_seen`` updated, 
+        and a price is only recorded for newly inserted ads.
+
+        Parameters:
+            items (list): list of :class:`~immo_crawl.items.ImmoCrawlItem`
+
+        Returns:
+            tuple: list of the written items and list of ``(item, error)`` for the items 
+            that could not be written on their own
+        """
+        # A row can only be upserted once per statement
+        unique = list({item['url']: item for item in items}.values())
+        try:
+            with self.pool.connection('write_items') as conn, conn.cursor() as cur:
+                rows = execute_values(
+                    cur, 'INSERT INTO eva_data (address, zip, city, canton, price_chf, '
+                         'rooms, area_m2, floor, utilities_chf, date_available, date_scraped, '
+                         'date_last_seen, url, canonical_url) VALUES %s ON CONFLICT (url) DO UPDATE SET '
+                         'date_last_seen = GREATEST(eva_data.date_last_seen, EXCLUDED.date_last_seen) '
+                         'RETURNING url, xmax = 0;',
+                    [(item.get('address'), item.get('zip_code'), item.get('city'), item.get('canton'),
+                      item.get('price_chf'), item.get('rooms'), item.get('area_m2'), item.get('floor'),
+                      item.get('utilities_chf'), item.get('date_available'), item.get('date_scraped'),
+                      item.get('date_last_seen'), item['url'], item.get('canonical_url')) for item in unique],
+                    page_size=len(unique), fetch=True)
+                inserted = {url for url, is_new in rows if is_new}
+                prices = [(item['url'], item.get('date_scraped'), item.get('price_chf'))
+                          for item in unique if item['url'] in inserted]
+                write_prices(cur, prices, self.history_mode)
+                update_current_prices(cur, prices)
+        except psycopg2.OperationalError:
+            raise
+        except Exception as error:
+            if len(items) == 1:
+                return [], [(items[0], error)]
+            middle = len(items) // 2
+            written_first, failed_first = self.write_batch(items[:middle])
+            written_second, failed_second = self.write_batch(items[middle:])
+            return written_first + written_second, failed_first + failed_second
+        return items, []
+
+    def batch_written(self, result, spider):
+        """
+        Records the result of :meth:`write_batch` in the crawler stats and logs the items 
+        that could not be written. The written URLs are added to the visited URLs of the spider, 
+        and the written advertisements to its duplicate index (cf. :class:`LinkDuplicates`). 
+        All items of the batch are sent with the ``items_written`` signal (cf. :mod:`immo_crawl.signals`).
+        """
+        written, failed = result
+        spider.crawler.stats.inc_value('immo_crawl/db/written_items', len(written), spider=spider)
+        for item, error in failed:
+            spider.crawler.stats.inc_value('immo_crawl/db/failed_items', spider=spider)
+            spider.logger.error('Item could not be written to the database: %s (%s)', item['url'], error)
+        spider.crawler.signals.send_catch_log(signal=items_written, spider=spider,
+                                              items=written + [item for item, error in failed])
+        self.unavailable = False
+        visited_urls = getattr(spider, 'visited_urls', None)
+        if visited_urls is not None:
+            for item in written:
+                visited_urls.add(item['url'])
+        duplicate_index = getattr(spider, 'duplicate_index', None)
+        if duplicate_index is not None:
+            for item in written:
+                duplicate_index.add(item['url'], item.get('address'), item.get('zip_code'),
+                                    item.get('rooms'), item.get('area_m2'), item.get('floor'))
+
+    def batch_failed(self, failure, items, spider):
+        """
+        Puts the items back into the buffer if the database could not be reached, unless the 
+        spider is being closed. Otherwise the items are counted as failed and the error is logged.
+        """
+        if failure.check(psycopg2.OperationalError) and not self.closing:
+            self.unavailable = True
+            self.buffer[:0] = items
+            spider.crawler.stats.inc_value('immo_crawl/db/deferred_batches', spider=spider)
+            spider.logger.warning('Database unavailable, %d items are written with the next flush: %s',
+                                  len(items), failure.value)
+            return
+        spider.crawler.stats.inc_value('immo_crawl/db/failed_items', len(items), spider=spider)
+        spider.logger.error('%d items could not be written to the database: %s', len(items), failure.value)
+
+
+class InvalidItem(DropItem):
+    """
+    :class:`~scrapy.exceptions.DropItem` with a reason code (e.g. ``invalid_zip_code``), which
+    is used as message of the drop and counted in the crawler stats (cf. :func:`drop`).
+
+    Attributes:
+        reason (str): code of the reason why the item was dropped
+    """
 
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
 
-class SetDefaultValues(object):
+
+def drop(spider, reason):
     """
-    Default values are defined for the optional data fields if the values could 
-    not be read from the HTML code.
+    Counts a dropped item as ``immo_crawl/dropped/<reason>`` in the crawler stats.
+
+    Returns:
+        InvalidItem: the exception to raise
     """
+    spider.crawler.stats.inc_value('immo_crawl/dropped/{}'.format(reason), spider=spider)
+    return InvalidItem(reason)
 
-    def process_item(self, item, spider):
-        item['area_m2'] = item.get('area_m2', None)
-        item['floor'] = item.get('floor', None)
-        item['utilities_chf'] = item.get('utilities_chf', None)
-        item['date_available'] = item.get('date_available', None)
-        return item
+
+def to_int(value):
+    """
+    Returns the value as integer, or ``None`` if it is empty or not numerical.
+    """
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def to_date(value):
+    """
+    Returns a date of the format ``dd.mm.yyyy`` as datetime, or ``None`` if it is not a valid date.
+    Dates that were already converted (cf. :class:`~immo_crawl.extraction.EmbeddedJsonExtractor`) are kept.
+    """
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(value, '%d.%m.%Y')
+    except (ValueError, TypeError):
+        return None
 
 
-class CleanData(object):
+class ValidateAndClean(object):
     """
-    The data is cleansed by converting the strings contained in  
-    :class:`~immo_crawl.items.ImmoCrawlItem` into numerical values and date types.
+    Validates and cleans the data of the :class:`~immo_crawl.items.ImmoCrawlItem` in a single stage.
+
+    The cheap checks of the required fields (zip code, rooms, price) are done first, so that 
+    invalid items are dropped before any optional field is converted. Each field is converted 
+    only once, optional fields that are missing or invalid are set to ``None``, so that every 
+    field is set when the item is written (e.g. an item from the JSON state without street). 
+    Every drop has a reason code (cf. :class:`InvalidItem`).
+
+    Attributes:
+        optional_int_fields (tuple): optional fields that are converted to integers
+        optional_text_fields (tuple): optional fields that are kept as text
     """
+    optional_int_fields = ('area_m2', 'utilities_chf')
+    optional_text_fields = ('address', 'city', 'canton', 'floor')
 
+    @timed_stage
     def process_item(self, item, spider):
+        zip_code = item.get('zip_code')
+        if zip_code is None:
+            raise drop(spider, 'missing_zip_code')
+        if not (len(zip_code) == 4 and zip_code.isdecimal()):
+            raise drop(spider, 'invalid_zip_code')
+
+        if not item.get('rooms'):
+            raise drop(spider, 'missing_rooms')
+
+        price = item.get('price_chf')
+        if price is None:
+            raise drop(spider, 'missing_price')
         try:
-            item['price_chf'] = int(item['price_chf'])
-        except (ValueError, KeyError):
-            raise DropItem
-
-        if item['area_m2'] == '':
-            item['area_m2'] = None
-        elif item['area_m2']:
-            try:
-                item['area_m2'] = int(item['area_m2'])
-            except ValueError:
-                item['area_m2'] = None
-
-        if item['utilities_chf'] == '':
-            item['utilities_chf'] = None
-        elif item['utilities_chf']:
-            try:
-                item['utilities_chf'] = int(item['utilities_chf'])
-            except ValueError:
-                item['utilities_chf'] = None
-
-        if item['floor'] == '':
-            item['floor'] = None
+            item['price_chf'] = int(price)
+        except ValueError:
+            raise drop(spider, 'invalid_price')
 
-        try:
-            item['date_available'] = datetime.strptime(
-                item['date_available'], '%d.%m.%Y')
-        except (ValueError, TypeError, KeyError):
-            item['date_available'] = None
+        for field in self.optional_int_fields:
+            item[field] = to_int(item.get(field))
+        for field in self.optional_text_fields:
+            item[field] = item.get(field) or None
+        item['date_available'] = to_date(item.get('date_available'))
 
         return item
 
 
-class DataValidation(object):
+class LinkDuplicates(object):
     """
-    Checks whether the data fields of the :class:`~immo_crawl.items.ImmoCrawlItem`
-    contain valid values.
+    Links an advertisement to the canonical listing of the same apartment, if the apartment 
+    is already stored under another URL, e.g. from the other portal (cf. :mod:`immo_crawl.duplicates`). 
+    The URL of the canonical listing is written with the item by :class:`WriteToDB`.
+
+    The index is only read here. It is shared with :class:`WriteToDB` as ``duplicate_index`` of
+    the spider, which adds an advertisement once it has been written, so that an item that is
+    dropped or fails to be written does not become the canonical listing of its fingerprint.
+
+    Attributes:
+        pool (:class:`~immo_crawl.database.ConnectionPool`): pool from which the connections are taken
+        index (:class:`~immo_crawl.duplicates.DuplicateIndex`): fingerprints of the stored advertisements
     """
 
-    def process_item(self, item, spider):
-        try:
-            if not (item['zip_code'].isdecimal() and len(item['zip_code']) == 4):
-                raise DropItem
-        except KeyError:
-            raise DropItem
+    def __init__(self, pool):
+        self.pool = pool
 
-        try:
-            if item['rooms'] == '':
-                raise DropItem
-        except KeyError:
-            raise DropItem
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(get_pool(crawler))
+
+    def open_spider(self, spider):
+        """
+        Loads the fingerprints of all stored advertisements.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when the index has been loaded
+        """
+        d = self.pool.run('load_duplicate_index', DuplicateIndex.load, self.pool.itersize)
+        d.addCallback(self.index_loaded, spider)
+        return d
 
+    def index_loaded(self, index, spider):
+        self.index = spider.duplicate_index = index
+        spider.logger.info('Loaded the fingerprints of %d listings', len(index))
+
+    @timed_stage
+    def process_item(self, item, spider):
+        item['canonical_url'] = self.index.lookup(item['url'], item.get('address'), item.get('zip_code'),
+                                                  item.get('rooms'), item.get('area_m2'), item.get('floor'))
+        if item['canonical_url'] is not None:
+            spider.crawler.stats.inc_value('immo_crawl/duplicates/linked', spider=spider)
         return item
 
 
@@ -125,11 +370,14 @@ class PriceCheckValidation(object):
     Checks whether the extracted data are numerical values.
     """
 
+    @timed_stage
     def process_item(self, item, spider):
         try:
             item['price_chf'] = int(item['price_chf'])
-        except (ValueError, KeyError):
-            raise DropItem
+        except KeyError:
+            raise drop(spider, 'missing_price')
+        except ValueError:
+            raise drop(spider, 'invalid_price')
 
         return item
 
@@ -138,33 +386,42 @@ class WritePrice(object):
     """
     The data of the :class:`~immo_crawl.spiders.pricecheck_spider.PricecheckSpider` 
     is written to the price table of the database.
+
+    Attributes:
+        pool (:class:`~immo_crawl.database.ConnectionPool`): pool from which the connections are taken
+        history_mode (str): storage mode of the price history (cf. :func:`~immo_crawl.history.write_prices`)
     """
 
-    def open_spider(self, spider):
-        """
-        A connection to the database is established when the 
-        :class:`~immo_crawl.spiders.pricecheck_spider.PricecheckSpider` is started.
-        """
-        self.conn = psycopg2.connect(
-            host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
-        self.cur = self.conn.cursor()
+    def __init__(self, pool, history_mode='points'):
+        self.pool = pool
+        self.history_mode = history_mode
 
-    def close_spider(self, spider):
-        """
-        When the spider has finished its run, the database connection that was established 
-        at the start (:meth:`open_spider`) is closed again.
-        """
-        self.cur.close()
-        self.conn.close()
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(get_pool(crawler), history_mode=crawler.settings.get('PRICE_HISTORY_MODE', 'points'))
 
+    @timed_stage
     def process_item(self, item, spider):
         """
         The data of the :class:`~immo_crawl.items.PriceCheckItem` is written to 
-        the price table of the database.
+        the price table of the database in the thread pool of :attr:`pool`. Afterwards 
+        the latest price of the URL is updated (cf. :class:`ComparePrice`).
         """
-        self.cur.execute('INSERT INTO eva_prices (url, date, price_chf) VALUES (%s, %s, %s);',
-                         (item['url'], item['date'], item['price_chf']))
-        self.conn.commit()
+        d = self.pool.run('write_price', self.insert_price, item)
+        d.addCallback(self.price_written, item, spider)
+        return d
+
+    def insert_price(self, conn, item):
+        prices = [(item['url'], item['date'], item['price_chf'])]
+        with conn.cursor() as cur:
+            write_prices(cur, prices, self.history_mode)
+            update_current_prices(cur, prices)
+
+    @staticmethod
+    def price_written(result, item, spider):
+        latest_prices = getattr(spider, 'latest_prices', None)
+        if latest_prices is not None:
+            latest_prices[item['url']] = item['price_chf']
         return item
 
 
@@ -174,34 +431,48 @@ class ComparePrice(object):
     with the latest price for the corresponding URL in the price table of the database 
     to decide whether a new entry should be created in the price table or the 
     :class:`~immo_crawl.items.PriceCheckItem` should be dropped.
+
+    Attributes:
+        pool (:class:`~immo_crawl.database.ConnectionPool`): pool from which the connections are taken
+        latest_prices (dict): latest price for each URL of the price table
     """
 
+    def __init__(self, pool):
+        self.pool = pool
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(get_pool(crawler))
+
     def open_spider(self, spider):
         """
-        A connection to the database is established when the 
-        :class:`~immo_crawl.spiders.pricecheck_spider.PricecheckSpider` is started.
-        """
-        self.conn = psycopg2.connect(
-            host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
-        self.cur = self.conn.cursor()
+        When the :class:`~immo_crawl.spiders.pricecheck_spider.PricecheckSpider` is started, 
+        the latest price of each URL is loaded from the table of current prices. 
+        The prices are shared with :class:`WritePrice` through the spider.
 
-    def close_spider(self, spider):
-        """
-        When the spider has finished its run, the database connection that was established 
-        at the start (:meth:`open_spider`) is closed again.
+        Returns:
+            twisted.internet.defer.Deferred: fires when the prices have been loaded
         """
-        self.cur.close()
-        self.conn.close()
+        d = self.pool.run('load_latest_prices', self.load_latest_prices)
+        d.addCallback(self.prices_loaded, spider)
+        return d
+
+    @staticmethod
+    def load_latest_prices(conn):
+        with conn.cursor() as cur:
+            cur.execute('SELECT url, price_chf FROM eva_current_prices;')
+            return dict(cur)
+
+    def prices_loaded(self, latest_prices, spider):
+        self.latest_prices = spider.latest_prices = latest_prices
 
+    @timed_stage
     def process_item(self, item, spider):
         """
         The most recent price in the price table of the database is compared with 
         the price in the :class:`~immo_crawl.items.PriceCheckItem`.
         """
-        self.cur.execute('SELECT price_chf FROM eva_prices WHERE url = %s ORDER BY date desc',
-                         (item['url'], ))
-        price = self.cur.fetchone()[0]
-        if item['price_chf'] == price:
-            raise DropItem
+        if item['price_chf'] == self.latest_prices.get(item['url']):
+            raise drop(spider, 'price_unchanged')
         else:
             return item
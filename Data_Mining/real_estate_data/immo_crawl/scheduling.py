@@ -0,0 +1,250 @@
+import math
+import heapq
+import logging
+from datetime import date
+from scrapy import signals
+from twisted.internet import defer
+from immo_crawl.database import get_pool
+from immo_crawl.history import record_checks
+
+logger = logging.getLogger(__name__)
+
+# One URL per canonical listing: the canonical listing itself, or the duplicate seen last if it is offline
+HISTORY_QUERY = ('SELECT DISTINCT ON (coalesce(d.canonical_url, d.url)) d.url, d.date_scraped, p.last_change, '
+                 'coalesce(p.changes, 0) AS changes, s.last_checked FROM eva_data d '
+                 'LEFT JOIN eva_current_prices p ON p.url = d.url '
+                 'LEFT JOIN pricecheck_schedule s ON s.url = d.url '
+                 'WHERE d.date_last_seen > %(check_date)s '
+                 'ORDER BY coalesce(d.canonical_url, d.url), d.canonical_url IS NOT NULL, d.date_last_seen DESC')
+
+
+def change_probability(rate, days):
+    """
+    Returns the probability that a price which changes ``rate`` times per day has changed
+    at least once within ``days`` days, assuming that the changes follow a Poisson process.
+    """
+    return 1.0 - math.exp(-rate * max(days, 0))
+
+
+class PriceCheckScheduler(object):
+    """
+    Decides which ads the :class:`~immo_crawl.spiders.pricecheck_spider.PricecheckSpider`
+    requests and in which order, based on the price history summarized in ``eva_current_prices``.
+
+    The change rate of an ad is the number of its price changes divided by its age (days since
+    it was first scraped). So that ads with a short history are not overrated, the rate is
+    shrunk towards the mean rate of all ads by a prior worth :attr:`prior_days` days. From the
+    rate and the days since the price was last known (last check, last change or first scrape),
+    the probability that the price has changed meanwhile is calculated.
+
+    An ad is due when this probability reaches :attr:`threshold`, which results in a re-check
+    interval per ad between :attr:`min_interval` and :attr:`max_interval` days. The probability
+    of a due ad is its request priority, so that the most likely changed ads are requested first.
+    At most :attr:`max_requests` ads are requested per run. The date of each check is stored
+    in the table ``pricecheck_schedule``. Of the ads of the same apartment (cf. :mod:`immo_crawl.duplicates`),
+    only one URL is checked.
+
+    When the spider is closed, the number of changes expected for the checked ads is compared
+    with the number of changes observed, i.e. the items that passed all pipelines.
+
+    Attributes:
+        pool (:class:`~immo_crawl.database.ConnectionPool`): pool from which the connections are taken
+        stats (scrapy.statscollectors.StatsCollector): stats of the crawler
+        threshold (float): change probability from which an ad is due
+        min_interval (int): minimum number of days between two checks of an ad
+        max_interval (int): number of days after which an ad is checked regardless of its probability
+        max_requests (int): maximum number of requests per run (0 for no limit)
+        prior_days (int): weight of the mean change rate in days of observation
+        batch_size (int): number of checked URLs that triggers an update of ``pricecheck_schedule``
+        due_ads (list): ``(url, probability)`` of the due ads that have not been requested yet
+    """
+
+    def __init__(self, pool, stats, threshold=0.2, min_interval=1, max_interval=7, max_requests=0,
+                 prior_days=14, batch_size=1000):
+        self.pool = pool
+        self.stats = stats
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_requests = max_requests
+        self.prior_days = prior_days
+        self.batch_size = batch_size
+        self.due_ads = []
+        self.checked = []
+        self.pending = set()
+        self.expected = 0.0
+        self.observed = 0
+
+    @classmethod
+    def from_spider(cls, spider):
+        settings = spider.settings
+        scheduler = cls(get_pool(spider.crawler), spider.crawler.stats,
+                        threshold=settings.getfloat('PRICECHECK_CHANGE_THRESHOLD', 0.2),
+                        min_interval=settings.getint('PRICECHECK_MIN_INTERVAL', 1),
+                        max_interval=settings.getint('PRICECHECK_MAX_INTERVAL', 7),
+                        max_requests=settings.getint('PRICECHECK_MAX_REQUESTS', 0),
+                        prior_days=settings.getint('PRICECHECK_PRIOR_DAYS', 14))
+        spider.crawler.signals.connect(scheduler.response_downloaded, signal=signals.response_downloaded)
+        spider.crawler.signals.connect(scheduler.item_scraped, signal=signals.item_scraped)
+        return scheduler
+
+    def load_history(self, conn, check_date):
+        """
+        Yields ``(url, first_scraped, last_change, changes, last_checked)`` of all ads seen after ``check_date``.
+        The rows are fetched in batches from a server-side cursor (cf. ``DB_CURSOR_ITERSIZE``).
+        """
+        with conn.cursor(name='load_pricecheck_history') as cur:
+            cur.itersize = self.pool.itersize
+            cur.execute(HISTORY_QUERY + ';', {'check_date': check_date})
+            yield from cur
+
+    @staticmethod
+    def load_mean_rate(conn, check_date, today):
+        """
+        Returns the mean number of price changes per day of all ads seen after ``check_date``.
+        """
+        with conn.cursor() as cur:
+            cur.execute('SELECT coalesce(sum(changes), 0), '
+                        'coalesce(sum(greatest(%(today)s - coalesce(date_scraped, %(today)s), 1)), 0) '
+                        'FROM (' + HISTORY_QUERY + ') history;', {'check_date': check_date, 'today': today})
+            changes, days = cur.fetchone()
+        return changes / days if days else 0.0
+
+    def probability(self, ad, mean_rate, today):
+        """
+        Returns the number of days since the price of an ad was last known and the probability
+        that it has changed meanwhile.
+
+        Parameters:
+            ad (tuple): row of :meth:`load_history`
+            mean_rate (float): mean change rate of all ads
+            today (datetime.date): date of the run
+        """
+        url, first_scraped, last_change, changes, last_checked = ad
+        age = max((today - (first_scraped or today)).days, 1)
+        rate = (changes + mean_rate * self.prior_days) / (age + self.prior_days)
+        known = max((day for day in (first_scraped, last_change, last_checked) if day), default=today)
+        days = (today - known).days
+        return days, change_probability(rate, days)
+
+    def load(self, check_date, today=None):
+        """
+        Selects the ads that are due in a thread of the connection pool. The history is streamed 
+        and only the due ads are kept, so that neither the history nor a connection is held 
+        while the ads are requested. If the number of requests is limited (:attr:`max_requests`), 
+        the most likely changed ads are selected.
+
+        Parameters:
+            check_date (datetime.date): only ads seen after this date are checked
+            today (datetime.date): date of the run
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when the due ads have been selected (cf. :meth:`schedule`)
+        """
+        d = self.pool.run('load_pricecheck_history', self.select, check_date, today or date.today())
+        d.addCallback(self.selected)
+        return d
+
+    def select(self, conn, check_date, today):
+        mean_rate = self.load_mean_rate(conn, check_date, today)
+        self.stats.set_value('immo_crawl/pricecheck/mean_change_rate', mean_rate)
+        due = self.due(self.load_history(conn, check_date), mean_rate, today)
+        if self.max_requests:
+            return heapq.nlargest(self.max_requests, due, key=lambda ad: ad[1])
+        return list(due)
+
+    def selected(self, due):
+        self.due_ads = due
+        logger.info('%d of %d ads are due for a price check, %d are requested (mean change rate %.4f per day)',
+                    self.stats.get_value('immo_crawl/pricecheck/due', 0),
+                    self.stats.get_value('immo_crawl/pricecheck/candidates', 0), len(due),
+                    self.stats.get_value('immo_crawl/pricecheck/mean_change_rate', 0.0))
+
+    def schedule(self):
+        """
+        Yields the ads selected by :meth:`load`, which are released as they are yielded.
+
+        Yields:
+            tuple: ``(url, probability)`` of a due ad
+        """
+        due, self.due_ads = self.due_ads, []
+        due.reverse()
+        while due:
+            self.stats.inc_value('immo_crawl/pricecheck/scheduled')
+            yield due.pop()
+
+    def due(self, history, mean_rate, today):
+        """
+        Yields ``(url, probability)`` of the ads of ``history`` that are due.
+        """
+        for ad in history:
+            self.stats.inc_value('immo_crawl/pricecheck/candidates')
+            days, probability = self.probability(ad, mean_rate, today)
+            if days >= self.max_interval or (days >= self.min_interval and probability >= self.threshold):
+                self.stats.inc_value('immo_crawl/pricecheck/due')
+                yield ad[0], probability
+
+    @staticmethod
+    def priority(probability):
+        """
+        Returns the request priority of an ad, so that the most likely changed ads are requested first.
+        """
+        return int(probability * 1000)
+
+    def response_downloaded(self, response, request, spider):
+        """
+        Records the check of an ad, including responses that are dropped by the downloader middlewares.
+        """
+        probability = request.meta.get('change_probability')
+        if probability is None:
+            return
+        self.expected += probability
+        self.stats.inc_value('immo_crawl/pricecheck/checked', spider=spider)
+        self.checked.append(request.meta.get('redirect_urls', [request.url])[0])
+        if len(self.checked) >= self.batch_size:
+            self.flush()
+
+    def item_scraped(self, item, response, spider):
+        """
+        Counts an observed price change: only changed prices pass :class:`~immo_crawl.pipelines.ComparePrice`.
+        """
+        self.observed += 1
+        self.stats.inc_value('immo_crawl/pricecheck/observed_changes', spider=spider)
+
+    def flush(self):
+        """
+        Stores the date of the recorded checks in ``pricecheck_schedule``.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when all pending updates have finished
+        """
+        if self.checked:
+            urls, self.checked = self.checked, []
+            d = self.pool.run('update_pricecheck_schedule', self.update, urls)
+            d.addErrback(lambda failure: logger.error(
+                'The check date of %d ads could not be stored: %s', len(urls), failure.value))
+            self.pending.add(d)
+            d.addBoth(lambda _: self.pending.discard(d))
+        return defer.DeferredList(list(self.pending))
+
+    @staticmethod
+    def update(conn, urls):
+        with conn.cursor() as cur:
+            record_checks(cur, urls, date.today())
+
+    def close(self):
+        """
+        Reports the expected and observed change rate and stores the remaining checks.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when all pending updates have finished
+        """
+        checked = self.stats.get_value('immo_crawl/pricecheck/checked', 0)
+        if checked:
+            self.stats.set_value('immo_crawl/pricecheck/expected_changes', round(self.expected, 1))
+            self.stats.set_value('immo_crawl/pricecheck/expected_change_rate', self.expected / checked)
+            self.stats.set_value('immo_crawl/pricecheck/observed_change_rate', self.observed / checked)
+            logger.info('Checked %d ads: %.1f price changes expected (%.1f%%), %d observed (%.1f%%)',
+                        checked, self.expected, 100 * self.expected / checked,
+                        self.observed, 100 * self.observed / checked)
+        return self.flush()
@@ -0,0 +1,246 @@
+import os
+import socket
+import inspect
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
+from twisted.internet import defer, task
+from immo_crawl.database import get_pool
+
+
+class ShardQueue(object):
+    """
+    Queue of the shards (start paths, i.e. cantons) of a distributed crawl, stored in the
+    table ``crawl_shards`` of the database (cf. :mod:`immo_crawl.schema`). Every worker claims
+    one shard at a time, so the cantons are distributed among all workers of the same run.
+    A claim is a lease of ``timeout`` seconds, which the worker renews while it crawls the
+    shard (cf. :meth:`renew`). Shards whose lease has expired, e.g. because their worker was
+    killed, are handed out again.
+
+    The URLs of the advertisements are claimed in the table ``crawl_shard_urls``, so that
+    an advertisement is only requested by one worker per run. The claimed URLs of a run are
+    deleted as soon as all of its shards are done.
+
+    All operations run in the thread pool of :attr:`pool` and return Deferreds.
+
+    Attributes:
+        pool (:class:`~immo_crawl.database.ConnectionPool`): pool from which the connections are taken
+        run (str): identifier of the distributed run
+        spider (str): name of the spider
+        worker (str): identifier of this worker
+        timeout (int): seconds after the claim or its last renewal after which a shard is handed out again
+    """
+
+    def __init__(self, pool, run, spider, worker, timeout=600):
+        self.pool = pool
+        self.run = run
+        self.spider = spider
+        self.worker = worker
+        self.timeout = timeout
+
+    def enqueue(self, shards):
+        """
+        Adds the shards of the run. Shards that were already added by another worker are kept.
+
+        Parameters:
+            shards (list): start paths of the spider
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when the shards have been added
+        """
+        return self.pool.run('enqueue_shards', self.insert_shards, shards)
+
+    def insert_shards(self, conn, shards):
+        with conn.cursor() as cur:
+            cur.executemany("INSERT INTO crawl_shards (run, spider, shard, position, state) "
+                            "VALUES (%s, %s, %s, %s, 'pending') ON CONFLICT DO NOTHING;",
+                            [(self.run, self.spider, shard, position) for position, shard in enumerate(shards)])
+
+    def claim(self):
+        """
+        Claims the next pending shard for this worker.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with the claimed start path, or with ``None``
+            if all shards have been claimed
+        """
+        return self.pool.run('claim_shard', self.claim_shard)
+
+    def claim_shard(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("UPDATE crawl_shards SET state = 'claimed', worker = %s, claimed_at = now() "
+                        "WHERE (run, spider, shard) = ("
+                        "SELECT run, spider, shard FROM crawl_shards WHERE run = %s AND spider = %s "
+                        "AND (state = 'pending' OR (state = 'claimed' AND claimed_at < now() - %s * interval '1 second')) "
+                        "ORDER BY position LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING shard;",
+                        (self.worker, self.run, self.spider, self.timeout))
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def renew(self, shard):
+        """
+        Extends the lease of a shard that this worker is crawling.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with ``False`` if the shard is no longer
+            claimed by this worker, e.g. because its lease had expired
+        """
+        return self.pool.run('renew_shard', self.renew_shard, shard)
+
+    def renew_shard(self, conn, shard):
+        with conn.cursor() as cur:
+            cur.execute("UPDATE crawl_shards SET claimed_at = now() WHERE run = %s AND spider = %s "
+                        "AND shard = %s AND state = 'claimed' AND worker = %s;",
+                        (self.run, self.spider, shard, self.worker))
+            return cur.rowcount == 1
+
+    def finish(self, shard):
+        """
+        Marks a shard as done.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when the shard has been marked
+        """
+        return self.pool.run('finish_shard', self.finish_shard, shard)
+
+    def finish_shard(self, conn, shard):
+        with conn.cursor() as cur:
+            cur.execute("UPDATE crawl_shards SET state = 'done' WHERE run = %s AND spider = %s AND shard = %s;",
+                        (self.run, self.spider, shard))
+            # The claimed URLs are only needed while a shard of their run is crawled
+            cur.execute("DELETE FROM crawl_shard_urls u WHERE NOT EXISTS ("
+                        "SELECT 1 FROM crawl_shards s WHERE s.run = u.run AND s.state <> 'done');")
+
+    def claim_urls(self, urls):
+        """
+        Claims the URLs of advertisements for this worker.
+
+        Parameters:
+            urls (list): URLs found on a results page
+
+        Returns:
+            twisted.internet.defer.Deferred: fires with the set of URLs that have not been
+            claimed by any worker before
+        """
+        if not urls:
+            return defer.succeed(set())
+        return self.pool.run('claim_urls', self.insert_urls, list(urls))
+
+    def insert_urls(self, conn, urls):
+        with conn.cursor() as cur:
+            cur.execute('INSERT INTO crawl_shard_urls (run, url, worker) '
+                        'SELECT %s, url, %s FROM unnest(%s) AS url ON CONFLICT DO NOTHING RETURNING url;',
+                        (self.run, self.worker, urls))
+            return {row[0] for row in cur}
+
+
+class ShardScheduler(object):
+    """
+    Lets a spider crawl only the shards it claims from the :class:`ShardQueue`. The next shard
+    is claimed when the spider becomes idle, i.e. when all requests of the current shard have
+    been processed. The spider is kept open while a shard is being claimed and closes when no
+    shard is left. The lease of the current shard is renewed every third of the timeout of the
+    queue, so that a shard that takes longer than the timeout is not handed out again.
+
+    The spider must provide ``start_paths`` and a method ``start_request(start_path)``.
+
+    Attributes:
+        spider (scrapy.Spider): the sharded spider
+        queue (ShardQueue): queue of the distributed run
+        shard (str): start path that is currently crawled
+        claiming (twisted.internet.defer.Deferred): the claim of the next shard, while it is pending
+        exhausted (bool): whether all shards have been claimed
+        heartbeat (twisted.internet.task.LoopingCall): periodic renewal of the lease of :attr:`shard`
+    """
+
+    def __init__(self, spider, queue):
+        self.spider = spider
+        self.queue = queue
+        self.shard = None
+        self.claiming = None
+        self.exhausted = False
+        self.heartbeat = task.LoopingCall(self.renew)
+
+    @classmethod
+    def from_spider(cls, spider):
+        worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+        queue = ShardQueue(get_pool(spider.crawler), spider.shard_run, spider.name, worker,
+                           timeout=spider.settings.getint('SHARD_TIMEOUT', 600))
+        scheduler = cls(spider, queue)
+        spider.crawler.signals.connect(scheduler.spider_idle, signal=signals.spider_idle)
+        spider.crawler.signals.connect(scheduler.spider_closed, signal=signals.spider_closed)
+        return scheduler
+
+    def start_requests(self):
+        """
+        Adds the start paths of the spider to the queue and claims the first shard, whose
+        request is scheduled as soon as the claim is done.
+
+        Returns:
+            list: no request, the spider is kept open until the first shard is claimed
+        """
+        self.next_shard(self.queue.enqueue(self.spider.start_paths))
+        return []
+
+    def next_shard(self, d=None):
+        """
+        Finishes the current shard and claims the next one after ``d`` has fired.
+        """
+        if self.heartbeat.running:
+            self.heartbeat.stop()
+        if d is None:
+            d = self.queue.finish(self.shard) if self.shard else defer.succeed(None)
+        d.addCallback(lambda _: self.queue.claim())
+        d.addCallback(self.shard_claimed)
+        d.addErrback(self.claim_failed)
+        self.claiming = d
+        d.addBoth(self.claim_done)
+
+    def shard_claimed(self, shard):
+        self.shard = shard
+        if shard is None:
+            self.exhausted = True
+            return
+        self.spider.logger.info('Claimed shard %s of run %s', shard, self.queue.run)
+        self.heartbeat.start(self.queue.timeout / 3.0, now=False)
+        self.crawl(self.spider.start_request(shard))
+
+    def renew(self):
+        d = self.queue.renew(self.shard)
+        d.addCallback(self.renewed, self.shard)
+        d.addErrback(lambda failure: self.spider.logger.warning(
+            'The lease of shard %s could not be renewed: %s', self.shard, failure.value))
+        return d
+
+    def renewed(self, renewed, shard):
+        if not renewed:
+            self.spider.logger.warning('Shard %s of run %s was handed out to another worker', shard, self.queue.run)
+
+    def claim_failed(self, failure):
+        self.spider.logger.error('No shard of run %s could be claimed: %s', self.queue.run, failure.value)
+        self.exhausted = True
+
+    def claim_done(self, result):
+        self.claiming = None
+
+    def crawl(self, request):
+        engine = self.spider.crawler.engine
+        # Scrapy before 2.6 also requires the spider
+        spider = inspect.signature(engine.crawl).parameters.get('spider')
+        if spider is not None and spider.default is inspect.Parameter.empty:
+            engine.crawl(request, self.spider)
+        else:
+            engine.crawl(request)
+
+    def spider_idle(self, spider):
+        if self.claiming is None:
+            if self.exhausted:
+                return
+            self.next_shard()
+        raise DontCloseSpider
+
+    def spider_closed(self, spider):
+        if self.heartbeat.running:
+            self.heartbeat.stop()
+
+    def claim_urls(self, urls):
+        return self.queue.claim_urls(urls)
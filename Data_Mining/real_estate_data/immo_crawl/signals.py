@@ -0,0 +1,13 @@
+"""
+Signals of the project, in addition to :mod:`scrapy.signals`. They are sent by the pipelines
+with ``crawler.signals.send_catch_log`` and connected like the signals of Scrapy.
+"""
+
+# Sent by WriteToDB when an item has been put into its buffer, i.e. before it is written.
+# Arguments: item, spider
+item_buffered = object()
+
+# Sent by WriteToDB when the write of buffered items has finished, including items that
+# could not be written on their own. Items that are kept for the next flush are not sent.
+# Arguments: items, spider
+items_written = object()
@@ -1,8 +1,15 @@
+import math
+import inspect
 import scrapy
-import psycopg2
+from scrapy import signals
 from datetime import date
-from immo_crawl.items import ImmoCrawlItem, HomeGateLoader
-from immo_crawl.credentials import HOSTNAME, USERNAME, PASSWORD, DATABASE
+from w3lib.url import add_or_replace_parameter
+from immo_crawl.database import SeenUrlUpdater, get_pool
+from immo_crawl.extraction import XPathExtractor, EmbeddedJsonExtractor, card_price, decimal_comma, iso_date
+from immo_crawl.parsing import get_parser_pool
+from immo_crawl.sharding import ShardScheduler
+from immo_crawl.visited import VisitedUrlLoader
+from immo_crawl.items import ImmoCrawlItem, HomeGateLoader, CompiledLoader
 
 
 class HomegateSpider(scrapy.Spider):
@@ -13,106 +20,259 @@ class HomegateSpider(scrapy.Spider):
     Attributes:
         name (str): name of the spider
         allowed_domains (list): list of allowed domains
+        base_url (str): URL of the website to which the paths of the start URLs are appended
+        shard_run (str): identifier of a distributed run shared by several workers (cf. :mod:`immo_crawl.sharding`)
+        start_paths (list): List with the path of the start URL for each canton.
+        canton_list (list): List with the abbreviations of the cantons (in the order of :attr:`start_paths`).
+        extractor (:class:`~immo_crawl.extraction.XPathExtractor`): XPath expressions for the fields of the advertisements
+        embedded (:class:`~immo_crawl.extraction.EmbeddedJsonExtractor`): keys of the fields in the JSON state of the advertisements
+        loader (:class:`~immo_crawl.items.CompiledLoader`): input processors of :class:`~immo_crawl.items.HomeGateLoader`
     """
     name = 'homegate'
     allowed_domains = ['homegate.ch']
+    base_url = 'https://www.homegate.ch'
+    shard_run = None
+    start_paths = [
+        '/mieten/immobilien/kanton-aargau/trefferliste',
+        '/mieten/immobilien/kanton-appenzellinnerrhoden/trefferliste',
+        '/mieten/immobilien/kanton-appenzellausserrhoden/trefferliste',
+        '/mieten/immobilien/kanton-baselland/trefferliste',
+        '/mieten/immobilien/kanton-baselstadt/trefferliste',
+        '/mieten/immobilien/kanton-bern/trefferliste',
+        '/mieten/immobilien/kanton-freiburg/trefferliste',
+        '/mieten/immobilien/kanton-genf/trefferliste',
+        '/mieten/immobilien/kanton-glarus/trefferliste',
+        '/mieten/immobilien/kanton-graubuenden/trefferliste',
+        '/mieten/immobilien/kanton-jura/trefferliste',
+        '/mieten/immobilien/kanton-luzern/trefferliste',
+        '/mieten/immobilien/kanton-neuenburg/trefferliste',
+        '/mieten/immobilien/kanton-nidwalden/trefferliste',
+        '/mieten/immobilien/kanton-obwalden/trefferliste',
+        '/mieten/immobilien/kanton-schaffhausen/trefferliste',
+        '/mieten/immobilien/kanton-schwyz/trefferliste',
+        '/mieten/immobilien/kanton-solothurn/trefferliste',
+        '/mieten/immobilien/kanton-stgallen/trefferliste',
+        '/mieten/immobilien/kanton-tessin/trefferliste',
+        '/mieten/immobilien/kanton-thurgau/trefferliste',
+        '/mieten/immobilien/kanton-uri/trefferliste',
+        '/mieten/immobilien/kanton-waadt/trefferliste',
+        '/mieten/immobilien/kanton-wallis/trefferliste',
+        '/mieten/immobilien/kanton-zug/trefferliste',
+        '/mieten/immobilien/kanton-zuerich/trefferliste',
+    ]
+    canton_list = ['AG', 'AI', 'AR', 'BL', 'BS', 'BE', 'FR', 'GE', 'GL', 'GR',
+                   'JU', 'LU', 'NE', 'NW', 'OW', 'SH', 'SZ', 'SO', 'SG', 'TI',
+                   'TG', 'UR', 'VD', 'VS', 'ZG', 'ZH']
+    extractor = XPathExtractor({
+        'address': '//address/span/text()',
+        'zip_code': '//address/span/text()',
+        'city': '//address/span/text()',
+        'rooms': '//div[h2="Eckdaten"]//dt[text()="Anzahl Zimmer:"]/following-sibling::*[1]//text()',
+        'area_m2': '//div[h2="Eckdaten"]//dt[text()="Wohnfläche:"]/following-sibling::*[1]/text()',
+        'price_chf': '//div[h2="Kosten"]//dt[text()="Miete:"]/following-sibling::*[1]//text()',
+        'date_available': '//div[h2="Verfügbarkeit"]//dt[text()="Verfügbar ab:"]/following-sibling::*[1]//text()',
+        'floor': '//div[h2="Eckdaten"]//dt[text()="Etage:"]/following-sibling::*[1]/text()',
+        'utilities_chf': '//div[h2="Kosten"]//dt[text()="Nebenkosten:"]/following-sibling::*[1]//text()',
+    })
+    embedded = EmbeddedJsonExtractor(b'__INITIAL_STATE__', ('listing', 'listing'), {
+        'address': (('address', 'street'), str),
+        'zip_code': (('address', 'postalCode'), str),
+        'city': (('address', 'locality'), str),
+        'rooms': (('characteristics', 'numberOfRooms'), decimal_comma),
+        'area_m2': (('characteristics', 'livingSpace'), int),
+        'price_chf': (('prices', 'rent', 'gross'), int),
+        'date_available': (('availableFrom', ), iso_date),
+        'floor': (('characteristics', 'floor'), str),
+        'utilities_chf': (('prices', 'rent', 'extra'), int),
+    }, required=('zip_code', 'rooms', 'price_chf'))
+    loader = CompiledLoader(HomeGateLoader, ImmoCrawlItem)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        return spider
+
+    def spider_opened(self, spider):
+        """
+        Starts loading the URLs that have already been visited in a thread of the connection pool 
+        (cf. :class:`~immo_crawl.visited.VisitedUrlLoader`). The first results pages are requested 
+        meanwhile, :meth:`parse` waits for the index.
+        """
+        self.visited_urls = None
+        self.visited = VisitedUrlLoader(get_pool(self.crawler))
+        self.visited.wait().addErrback(self.visited_urls_failed)
+
+    def visited_urls_failed(self, failure):
+        self.logger.error('The visited URLs could not be loaded: %s', failure.value)
+        self.crawler.engine.close_spider(self, 'visited_urls_failed')
 
     def start_requests(self):
         """
-        Sends requests with the start_urls.
+        Sends requests with the start URLs (cf. :attr:`start_paths`). If the spider is started 
+        with ``-a shard_run=<id>``, only the cantons claimed from the 
+        :class:`~immo_crawl.sharding.ShardScheduler` are crawled.
 
         Yields:
             :class:`scrapy:scrapy.http.Request`: HTTP request that is processed with :meth:`parse`.
+        """
+        self.seen_urls = SeenUrlUpdater.from_crawler(self.crawler)
+        self.card_prices = self.settings.getbool('CARD_PRICES_ENABLED', True)
+        self.parser_pool = get_parser_pool(self.crawler)
+        self.shards = ShardScheduler.from_spider(self) if self.shard_run else None
 
-        Attributes:
-            start_urls (list): List with the start URL for each canton.
-            canton_list (list): List with the abbreviations of the cantons (in the order of :attr:`start_urls`).
-        """
-        # Create a list of URLs that have already been visited
-        conn = psycopg2.connect(
-            host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
-        with conn.cursor() as cur:
-            cur.execute('SELECT url FROM eva_data;')
-            self.visited_urls = [url[0] for url in cur.fetchall()]
-        conn.close()
-
-        start_urls = [
-            'https://www.homegate.ch/mieten/immobilien/kanton-aargau/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-appenzellinnerrhoden/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-appenzellausserrhoden/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-baselland/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-baselstadt/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-bern/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-freiburg/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-genf/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-glarus/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-graubuenden/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-jura/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-luzern/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-neuenburg/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-nidwalden/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-obwalden/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-schaffhausen/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-schwyz/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-solothurn/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-stgallen/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-tessin/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-thurgau/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-uri/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-waadt/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-wallis/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-zug/trefferliste',
-            'https://www.homegate.ch/mieten/immobilien/kanton-zuerich/trefferliste',
-        ]
-        canton_list = ['AG', 'AI', 'AR', 'BL', 'BS', 'BE', 'FR', 'GE', 'GL', 'GR',
-                       'JU', 'LU', 'NE', 'NW', 'OW', 'SH', 'SZ', 'SO', 'SG', 'TI',
-                       'TG', 'UR', 'VD', 'VS', 'ZG', 'ZH']
-        canton_dict = dict(zip(start_urls, canton_list))
+        # In a distributed run, the start URLs are claimed one canton at a time
+        if self.shards:
+            yield from self.shards.start_requests()
+            return
 
         # Send requests for the start URLs
-        for start_url in start_urls:
-            canton = canton_dict[start_url]
-            yield scrapy.Request(start_url, callback=self.parse, cb_kwargs={'canton': canton})
+        for start_path in self.start_paths:
+            yield self.start_request(start_path)
 
-    def parse(self, response, canton):
+    def start_request(self, start_path):
+        """
+        Creates the request for the first results page of a canton.
+
+        Parameters:
+            start_path (str): path of the start URL (cf. :attr:`start_paths`)
+
+        Returns:
+            :class:`scrapy:scrapy.http.Request`: HTTP request that is processed with :meth:`parse`.
+        """
+        canton = self.canton_list[self.start_paths.index(start_path)]
+        return scrapy.Request(self.base_url + start_path, callback=self.parse, cb_kwargs={'canton': canton})
+
+    def parse(self, response, canton, fanned_out=False, follow_next=False):
         """
         HTTP responses are processed that were requested with :meth:`start_requests` or :meth:`parse`.
-        Links to advertisements are processed using :meth:`parse_item`. Only requests 
-        for advertisements that have not yet been scraped will be sent. The current date is added to the database for existing URLs.
+        Links to advertisements are processed using :meth:`parse_item` (or :meth:`parse_item_in_pool` 
+        if ``PARSER_PROCESSES`` is set). Only requests 
+        for advertisements that have not yet been scraped will be sent. The current date and the price shown on the results page 
+        are added to the database for existing URLs (cf. :class:`~immo_crawl.database.SeenUrlUpdater`).
+
+        If the number of result pages can be read from the first page (cf. :meth:`last_page`), the 
+        requests for all other result pages are sent at once. Otherwise the link to the next page is followed. 
+        The last of these pages also follows the link to the next page, so that no page is lost if 
+        the number of pages was underestimated.
 
         Parameters:
             response (scrapy.http.Response): HTTP response to a sent request
             canton (str): Canton abbreviation assigned to the HTTP request sent
+            fanned_out (bool): ``True`` if the request was created for a known number of result pages
+            follow_next (bool): ``True`` if the link to the next page is followed although the page was fanned out
 
-        Yields:
-            :class:`scrapy:scrapy.http.Request`: HTTP request that will be processed with :meth:`parse` or :meth:`parse_item`
+        Returns:
+            iterable: HTTP requests (:class:`scrapy:scrapy.http.Request`) that will be processed with 
+            :meth:`parse` or :meth:`parse_item`
         """
+        # The results pages that arrive before the visited URLs have been loaded wait for them
+        if self.visited_urls is None:
+            return self.parse_when_loaded(response, canton=canton, fanned_out=fanned_out, follow_next=follow_next)
+
         # Processing the results pages
+        new_links = []
         for item_link in response.css('div[data-test="result-list"] a'):
             url = response.urljoin(item_link.css('::attr(href)').get())
             # If the URL is already in the database, the date is added to it (date_last_seen)
+            # and the price on the results page is compared with its current price
             if url in self.visited_urls:
-                conn = psycopg2.connect(
-                    host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
-                with conn.cursor() as cur:
-                    cur.execute(
-                        'UPDATE eva_data SET date_last_seen = %s WHERE url = %s;', (date.today(), url))
-                    conn.commit()
-                conn.close()
+                self.seen_urls.add(url, card_price(item_link) if self.card_prices else None)
                 continue
             else:
-                yield response.follow(item_link, self.parse_item, cb_kwargs={'canton': canton})
+                new_links.append((url, item_link))
 
-        # Request for the next page
+        # In a distributed run, only advertisements that no other worker has claimed are requested
+        if self.shards:
+            return self.follow_claimed_links(response, canton, new_links, fanned_out, follow_next)
+        return self.follow_links(response, canton, new_links, fanned_out, follow_next)
+
+    async def parse_when_loaded(self, response, **kwargs):
+        """
+        Like :meth:`parse`, after the URLs that have already been visited have been loaded.
+
+        Returns:
+            list: HTTP requests of :meth:`parse`
+        """
+        self.visited_urls = await self.visited.wait()
+        result = self.parse(response, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return list(result)
+
+    async def follow_claimed_links(self, response, canton, new_links, fanned_out=False, follow_next=False):
+        """
+        Like :meth:`follow_links`, after the advertisements have been claimed in the database 
+        (cf. :class:`~immo_crawl.sharding.ShardQueue`) without blocking the crawl.
+
+        Returns:
+            list: HTTP requests of :meth:`follow_links`
+        """
+        claimed_urls = await self.shards.claim_urls([url for url, item_link in new_links])
+        return list(self.follow_links(response, canton,
+                                      [(url, item_link) for url, item_link in new_links if url in claimed_urls],
+                                      fanned_out, follow_next))
+
+    def follow_links(self, response, canton, new_links, fanned_out=False, follow_next=False):
+        """
+        Requests the new advertisements of a results page and the other result pages (cf. :meth:`parse`).
+
+        Parameters:
+            new_links (list): ``(url, link)`` of the advertisements that have not yet been scraped
+
+        Yields:
+            :class:`scrapy:scrapy.http.Request`: HTTP request that will be processed with :meth:`parse` or :meth:`parse_item`
+        """
+        parse_item = self.parse_item_in_pool if self.parser_pool else self.parse_item
+        for url, item_link in new_links:
+            self.visited_urls.add(url)
+            yield response.follow(item_link, parse_item, cb_kwargs={'canton': canton})
+
+        # Requests for all remaining result pages, the last one continues with the link to the next page
+        last_page = None if fanned_out else self.last_page(response)
+        if last_page and last_page > 1:
+            for page_num in range(2, last_page + 1):
+                yield scrapy.Request(add_or_replace_parameter(response.url, 'ep', str(page_num)),
+                                     callback=self.parse, cb_kwargs={'canton': canton, 'fanned_out': True,
+                                                                     'follow_next': page_num == last_page})
+            return
+        if fanned_out and not follow_next:
+            return
+
+        # Request for the next page (pages already requested are dropped by the duplicate filter)
         next_page = response.css(
             'a[aria-label="Zur nächsten Seite"]::attr(href)').get()
         if next_page is not None:
-            yield response.follow(next_page, callback=self.parse, cb_kwargs={'canton': canton})
+            yield response.follow(next_page, callback=self.parse,
+                                  cb_kwargs={'canton': canton, 'fanned_out': fanned_out, 'follow_next': fanned_out})
+
+    @staticmethod
+    def last_page(response):
+        """
+        Determines the number of result pages from the page numbers of the pagination links 
+        or from the number of results shown in the heading. The link to the next page alone 
+        does not tell the number of pages.
+
+        Parameters:
+            response (scrapy.http.Response): HTTP response of a results page
+
+        Returns:
+            int: number of the last result page, or ``None`` if it cannot be determined
+        """
+        page_nums = [int(page_num) for page_num in
+                     response.css('a:not([aria-label="Zur nächsten Seite"])::attr(href)').re(r'[?&]ep=(\d+)')]
+        result_count = response.css('h1 ::text').re_first(r'([\d’\']+)\s+(?:Mietobjekte|Treffer|Ergebnisse)')
+        # A card may contain several links to its advertisement
+        results_per_page = len(set(response.css('div[data-test="result-list"] a::attr(href)').getall()))
+        if result_count and results_per_page:
+            result_count = int(result_count.replace('’', '').replace("'", ''))
+            page_nums.append(math.ceil(result_count / results_per_page))
+        return max(page_nums) if page_nums else None
 
     def parse_item(self, response, canton):
         """
         HTTP responses from :meth:`parse` are processed. The collected data will 
-        be written to an Item by a Loader object. 
+        be written to an Item by a Loader object (cf. :meth:`build_item`). 
 
         Parameters:
             response (scrapy.http.Response): HTTP response to a sent request
@@ -121,32 +281,61 @@ class HomegateSpider(scrapy.Spider):
         Yields:
             :class:`~immo_crawl.items.ImmoCrawlItem`: The Item that will be processed by
             :attr:`~immo_crawl.settings.ITEM_PIPELINES`.
+        """
+        yield self.build_item(response, canton)
+
+    async def parse_item_in_pool(self, response, canton):
+        """
+        Like :meth:`parse_item`, but the data is collected by :meth:`build_item` in a worker 
+        process of the :class:`~immo_crawl.parsing.ParserPool`.
+
+        Parameters:
+            response (scrapy.http.Response): HTTP response to a sent request
+            canton (str): Canton abbreviation assigned to the HTTP request sent
+
+        Returns:
+            list: The :class:`~immo_crawl.items.ImmoCrawlItem` that will be processed by
+            :attr:`~immo_crawl.settings.ITEM_PIPELINES`.
+        """
+        fields = await self.parser_pool.parse(self, response, canton=canton)
+        return [ImmoCrawlItem(fields)]
+
+    @classmethod
+    def build_item(cls, response, canton):
+        """
+        The data is collected from the HTML of an advertisement and written to an Item by the compiled 
+        Loader (cf. :attr:`loader`). If the page embeds the data of the advertisement as JSON state, 
+        the Item is built from it without parsing the HTML (cf. :attr:`embedded`).
+
+        Parameters:
+            response (scrapy.http.Response): HTTP response to a sent request
+            canton (str): Canton abbreviation assigned to the HTTP request sent
 
-        Attributes:
-            loader (:class:`~immo_crawl.items.HomeGateLoader`): object to collect data from HTML write to the Item
-            immo_item (:class:`~immo_crawl.items.ImmoCrawlItem`): container for storing the data to be written to the database
-        """
-        loader = HomeGateLoader(item=ImmoCrawlItem(), response=response)
-        loader.add_xpath('address', '//address/span/text()')
-        loader.add_xpath('zip_code', '//address/span/text()')
-        loader.add_xpath('city', '//address/span/text()')
-        loader.add_value('canton', canton)
-        loader.add_xpath(
-            'rooms', '//div[h2="Eckdaten"]//dt[text()="Anzahl Zimmer:"]/following-sibling::*[1]//text()')
-        loader.add_xpath(
-            'area_m2', '//div[h2="Eckdaten"]//dt[text()="Wohnfläche:"]/following-sibling::*[1]/text()')
-        loader.add_xpath(
-            'price_chf', '//div[h2="Kosten"]//dt[text()="Miete:"]/following-sibling::*[1]//text()')
-        loader.add_xpath('date_available', '//div[h2="Verfügbarkeit"]//dt[text()="Verfügbar ab:"]'
-                                           '/following-sibling::*[1]//text()')
-        loader.add_xpath(
-            'floor', '//div[h2="Eckdaten"]//dt[text()="Etage:"]/following-sibling::*[1]/text()')
-        loader.add_xpath('utilities_chf', '//div[h2="Kosten"]//dt[text()="Nebenkosten:"]'
-                                          '/following-sibling::*[1]//text()')
-        loader.add_value('date_scraped', date.today())
-        loader.add_value('date_last_seen', date.today())
-        loader.add_value('url', response.request.url)
-
-        immo_item = loader.load_item()
-
-        yield immo_item
+        Returns:
+            :class:`~immo_crawl.items.ImmoCrawlItem`: container for storing the data to be written to the database
+        """
+        # Fast path: the typed values of the JSON state, if the page has one
+        fields = cls.embedded.extract(response)
+        if fields is not None:
+            item = ImmoCrawlItem(fields)
+            item['canton'] = canton
+            item['date_scraped'] = date.today()
+            item['date_last_seen'] = date.today()
+            item['url'] = response.request.url
+            return item
+
+        record = cls.loader.load(cls.extractor.extract(response), canton=canton, date_scraped=date.today(),
+                                 date_last_seen=date.today(), url=response.request.url)
+        return record.item()
+
+    def closed(self, reason):
+        """
+        The URLs that were seen since the last update are written to the database when the spider is closed.
+
+        Parameters:
+            reason (str): reason why the spider was closed
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when all updates have finished
+        """
+        return self.seen_urls.flush()
@@ -1,8 +1,13 @@
+import inspect
 import scrapy
-import psycopg2
+from scrapy import signals
 from datetime import date
-from immo_crawl.items import ImmoCrawlItem, ImmoScoutLoader
-from immo_crawl.credentials import HOSTNAME, USERNAME, PASSWORD, DATABASE
+from immo_crawl.database import SeenUrlUpdater, get_pool
+from immo_crawl.extraction import XPathExtractor, EmbeddedJsonExtractor, card_price, iso_date, number_text
+from immo_crawl.parsing import get_parser_pool
+from immo_crawl.sharding import ShardScheduler
+from immo_crawl.visited import VisitedUrlLoader
+from immo_crawl.items import ImmoCrawlItem, ImmoScoutLoader, CompiledLoader
 
 
 class ImmoscoutSpider(scrapy.Spider):
@@ -13,92 +18,206 @@ class ImmoscoutSpider(scrapy.Spider):
     Attributes:
         name (str): name of the spider
         allowed_domains (list): list of allowed domains
+        base_url (str): URL of the website to which the paths of the start URLs are appended
+        shard_run (str): identifier of a distributed run shared by several workers (cf. :mod:`immo_crawl.sharding`)
+        start_paths (list): List with the path of the start URL for each canton.
+        extractor (:class:`~immo_crawl.extraction.XPathExtractor`): XPath expressions for the fields of the advertisements
+        embedded (:class:`~immo_crawl.extraction.EmbeddedJsonExtractor`): keys of the fields in the JSON state of the advertisements
+        loader (:class:`~immo_crawl.items.CompiledLoader`): input processors of :class:`~immo_crawl.items.ImmoScoutLoader`
     """
     name = 'immoscout'
     allowed_domains = ['immoscout24.ch']
+    base_url = 'https://www.immoscout24.ch'
+    shard_run = None
+    start_paths = [
+        '/de/immobilien/mieten/kanton-aargau?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-appenzell-ai?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-appenzell-ar?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-basel-landschaft?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-basel-stadt?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-bern?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-freiburg?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-genf?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-glarus?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-graubuenden?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-jura?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-luzern?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-neuenburg?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-nidwalden?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-obwalden?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-schaffhausen?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-schwyz?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-solothurn?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-st-gallen?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-tessin?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-thurgau?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-uri?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-waadt?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-wallis?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-zug?map=1&pn={}&se=16',
+        '/de/immobilien/mieten/kanton-zuerich?map=1&pn={}&se=16',
+    ]
+    extractor = XPathExtractor({
+        'address': '//article[h2="Standort"]//p/text()',
+        'zip_code': '//article[h2="Standort"]//p/text()',
+        'city': '//article[h2="Standort"]//p/text()',
+        'canton': '//article[h2="Standort"]//p/text()',
+        'rooms': '//article[1]/h2/text()',
+        'area_m2': '//article[1]/h2/text()',
+        'price_chf': '//article[1]/div/h2/text()',
+        'date_available': '//article[h2="Hauptangaben"]//tr[td="Verfügbarkeit"]//text()',
+        'floor': '//article[h2="Hauptangaben"]//tr[td="Stockwerk"]//text()',
+        'utilities_chf': '//article[h2="Preis"]//tr[starts-with(td,"Neben")]//text()',
+    })
+    embedded = EmbeddedJsonExtractor(b'__INITIAL_STATE__', ('pages', 'detail', 'propertyDetails'), {
+        'address': (('street', ), str),
+        'zip_code': (('zip', ), str),
+        'city': (('cityName', ), str),
+        'canton': (('stateShort', ), str),
+        'rooms': (('numberOfRooms', ), number_text),
+        'area_m2': (('surfaceLiving', ), int),
+        'price_chf': (('grossPrice', ), int),
+        'date_available': (('availableFrom', ), iso_date),
+        'floor': (('floor', ), str),
+        'utilities_chf': (('extraPrice', ), int),
+    }, required=('zip_code', 'rooms', 'price_chf'))
+    loader = CompiledLoader(ImmoScoutLoader, ImmoCrawlItem)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        return spider
+
+    def spider_opened(self, spider):
+        """
+        Starts loading the URLs that have already been visited in a thread of the connection pool 
+        (cf. :class:`~immo_crawl.visited.VisitedUrlLoader`). The first results pages are requested 
+        meanwhile, :meth:`parse` waits for the index.
+        """
+        self.visited_urls = None
+        self.visited = VisitedUrlLoader(get_pool(self.crawler))
+        self.visited.wait().addErrback(self.visited_urls_failed)
+
+    def visited_urls_failed(self, failure):
+        self.logger.error('The visited URLs could not be loaded: %s', failure.value)
+        self.crawler.engine.close_spider(self, 'visited_urls_failed')
 
     def start_requests(self):
         """
-        Sends requests with the start_urls.
+        Sends requests with the start URLs (cf. :attr:`start_paths`). If the spider is started 
+        with ``-a shard_run=<id>``, only the cantons claimed from the 
+        :class:`~immo_crawl.sharding.ShardScheduler` are crawled.
 
         Yields:
             :class:`scrapy:scrapy.http.Request`: HTTP request that is processed with :meth:`parse`.
+        """
+        self.seen_urls = SeenUrlUpdater.from_crawler(self.crawler)
+        self.card_prices = self.settings.getbool('CARD_PRICES_ENABLED', True)
+        self.parser_pool = get_parser_pool(self.crawler)
+        self.shards = ShardScheduler.from_spider(self) if self.shard_run else None
+
+        # In a distributed run, the start URLs are claimed one canton at a time
+        if self.shards:
+            yield from self.shards.start_requests()
+            return
 
-        Attributes:
-            start_urls (list): List with the start URL for each canton.
-        """
-        # Create a list of URLs that have already been visited
-        conn = psycopg2.connect(
-            host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
-        with conn.cursor() as cur:
-            cur.execute('SELECT url FROM eva_data;')
-            self.visited_urls = [url[0] for url in cur.fetchall()]
-        conn.close()
-
-        start_urls = [
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-aargau?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-appenzell-ai?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-appenzell-ar?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-basel-landschaft?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-basel-stadt?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-bern?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-freiburg?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-genf?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-glarus?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-graubuenden?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-jura?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-luzern?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-neuenburg?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-nidwalden?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-obwalden?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-schaffhausen?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-schwyz?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-solothurn?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-st-gallen?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-tessin?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-thurgau?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-uri?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-waadt?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-wallis?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-zug?map=1&pn={}&se=16',
-            'https://www.immoscout24.ch/de/immobilien/mieten/kanton-zuerich?map=1&pn={}&se=16',
-        ]
         # Send requests for the start URLs
+        for start_path in self.start_paths:
+            yield self.start_request(start_path)
+
+    def start_request(self, start_path):
+        """
+        Creates the request for the first results page of a canton.
+
+        Parameters:
+            start_path (str): path of the start URL (cf. :attr:`start_paths`)
+
+        Returns:
+            :class:`scrapy:scrapy.http.Request`: HTTP request that is processed with :meth:`parse`.
+        """
         page_nr = 1
-        for start_url in start_urls:
-            yield scrapy.Request(start_url.format(page_nr), callback=self.parse, cb_kwargs={'start_url': start_url})
+        start_url = self.base_url + start_path
+        return scrapy.Request(start_url.format(page_nr), callback=self.parse, cb_kwargs={'start_url': start_url})
 
     def parse(self, response, start_url=None):
         """
         HTTP responses are processed that were requested with :meth:`start_requests` or :meth:`parse`.
-        Links to advertisements are processed using :meth:`parse_item`. If the response follows a request
-        from :attr:`start_urls`, the URLs of the other result pages still have to be created. Only requests 
-        for advertisements that have not yet been scraped will be sent. The current date is added to the 
-        database for existing URLs.
+        Links to advertisements are processed using :meth:`parse_item` (or :meth:`parse_item_in_pool` 
+        if ``PARSER_PROCESSES`` is set). If the response follows a request
+        from :attr:`start_paths`, the URLs of the other result pages still have to be created. Only requests 
+        for advertisements that have not yet been scraped will be sent. The current date and the price shown 
+        on the results page are added to the database for existing URLs (cf. :class:`~immo_crawl.database.SeenUrlUpdater`).
 
         Parameters:
             response (scrapy.http.Response): HTTP response to a sent request
-            start_url (str): requested URL, when from :attr:`start_urls` it defaults to ``None``.
+            start_url (str): requested URL, when from :attr:`start_paths` it defaults to ``None``.
 
-        Yields:
-            :class:`scrapy:scrapy.http.Request`:HTTP request that will be processed with :meth:`parse` or :meth:`parse_item`
+        Returns:
+            iterable: HTTP requests (:class:`scrapy:scrapy.http.Request`) that will be processed with 
+            :meth:`parse` or :meth:`parse_item`
         """
+        # The results pages that arrive before the visited URLs have been loaded wait for them
+        if self.visited_urls is None:
+            return self.parse_when_loaded(response, start_url=start_url)
+
         # Processing the results pages
+        new_links = []
         for item_link in response.css('article a'):
             url = response.urljoin(item_link.css('::attr(href)').get())
             url = url.split('?')[0]
             # If the URL is already in the database, the date is added to it (date_last_seen)
+            # and the price on the results page is compared with its current price
             if url in self.visited_urls:
-                conn = psycopg2.connect(
-                    host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
-                with conn.cursor() as cur:
-                    cur.execute(
-                        'UPDATE eva_data SET date_last_seen = %s WHERE url = %s;', (date.today(), url))
-                    conn.commit()
-                conn.close()
+                self.seen_urls.add(url, card_price(item_link) if self.card_prices else None)
                 continue
             else:
-                yield response.follow(item_link, self.parse_item)
+                new_links.append((url, item_link))
+
+        # In a distributed run, only advertisements that no other worker has claimed are requested
+        if self.shards:
+            return self.follow_claimed_links(response, start_url, new_links)
+        return self.follow_links(response, start_url, new_links)
+
+    async def parse_when_loaded(self, response, **kwargs):
+        """
+        Like :meth:`parse`, after the URLs that have already been visited have been loaded.
+
+        Returns:
+            list: HTTP requests of :meth:`parse`
+        """
+        self.visited_urls = await self.visited.wait()
+        result = self.parse(response, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return list(result)
+
+    async def follow_claimed_links(self, response, start_url, new_links):
+        """
+        Like :meth:`follow_links`, after the advertisements have been claimed in the database 
+        (cf. :class:`~immo_crawl.sharding.ShardQueue`) without blocking the crawl.
+
+        Returns:
+            list: HTTP requests of :meth:`follow_links`
+        """
+        claimed_urls = await self.shards.claim_urls([url for url, item_link in new_links])
+        return list(self.follow_links(response, start_url,
+                                      [(url, item_link) for url, item_link in new_links if url in claimed_urls]))
+
+    def follow_links(self, response, start_url, new_links):
+        """
+        Requests the new advertisements of a results page and the other result pages (cf. :meth:`parse`).
+
+        Parameters:
+            new_links (list): ``(url, link)`` of the advertisements that have not yet been scraped
+
+        Yields:
+            :class:`scrapy:scrapy.http.Request`: HTTP request that will be processed with :meth:`parse` or :meth:`parse_item`
+        """
+        parse_item = self.parse_item_in_pool if self.parser_pool else self.parse_item
+        for url, item_link in new_links:
+            self.visited_urls.add(url)
+            yield response.follow(item_link, parse_item)
 
         # Create links if response to a start URL
         if start_url:
@@ -111,7 +230,7 @@ class ImmoscoutSpider(scrapy.Spider):
     def parse_item(self, response):
         """
         HTTP responses from :meth:`parse` are processed. The collected data will 
-        be written to an Item by a Loader object. 
+        be written to an Item by a Loader object (cf. :meth:`build_item`). 
 
         Parameters:
             response (scrapy.http.Response): HTTP response to a sent request
@@ -119,30 +238,59 @@ class ImmoscoutSpider(scrapy.Spider):
         Yields:
             :class:`~immo_crawl.items.ImmoCrawlItem`: The Item that will be processed by
             :attr:`~immo_crawl.settings.ITEM_PIPELINES`
+        """
+        yield self.build_item(response)
+
+    async def parse_item_in_pool(self, response):
+        """
+        Like :meth:`parse_item`, but the data is collected by :meth:`build_item` in a worker 
+        process of the :class:`~immo_crawl.parsing.ParserPool`.
+
+        Parameters:
+            response (scrapy.http.Response): HTTP response to a sent request
+
+        Returns:
+            list: The :class:`~immo_crawl.items.ImmoCrawlItem` that will be processed by
+            :attr:`~immo_crawl.settings.ITEM_PIPELINES`
+        """
+        fields = await self.parser_pool.parse(self, response)
+        return [ImmoCrawlItem(fields)]
 
-        Attributes:
-            loader (:class:`~immo_crawl.items.ImmoScoutLoader`): object to collect data from HTML write to the Item
-            immo_item (:class:`~immo_crawl.items.ImmoCrawlItem`): container for storing the data to be written to the database
+    @classmethod
+    def build_item(cls, response):
         """
+        The data is collected from the HTML of an advertisement and written to an Item by the compiled 
+        Loader (cf. :attr:`loader`). If the page embeds the data of the advertisement as JSON state, 
+        the Item is built from it without parsing the HTML (cf. :attr:`embedded`).
+
+        Parameters:
+            response (scrapy.http.Response): HTTP response to a sent request
+
+        Returns:
+            :class:`~immo_crawl.items.ImmoCrawlItem`: container for storing the data to be written to the database
+        """
+        # Fast path: the typed values of the JSON state, if the page has one
+        fields = cls.embedded.extract(response)
+        if fields is not None:
+            item = ImmoCrawlItem(fields)
+            item['date_scraped'] = date.today()
+            item['date_last_seen'] = date.today()
+            item['url'] = response.request.url.split('?')[0]
+            return item
+
         # Scraping the data
-        loader = ImmoScoutLoader(item=ImmoCrawlItem(), response=response)
-        loader.add_xpath('address', '//article[h2="Standort"]//p/text()')
-        loader.add_xpath('zip_code', '//article[h2="Standort"]//p/text()')
-        loader.add_xpath('city', '//article[h2="Standort"]//p/text()')
-        loader.add_xpath('canton', '//article[h2="Standort"]//p/text()')
-        loader.add_xpath('rooms', '//article[1]/h2/text()')
-        loader.add_xpath('area_m2', '//article[1]/h2/text()')
-        loader.add_xpath('price_chf', '//article[1]/div/h2/text()')
-        loader.add_xpath(
-            'date_available', '//article[h2="Hauptangaben"]//tr[td="Verfügbarkeit"]//text()')
-        loader.add_xpath(
-            'floor', '//article[h2="Hauptangaben"]//tr[td="Stockwerk"]//text()')
-        loader.add_xpath(
-            'utilities_chf', '//article[h2="Preis"]//tr[starts-with(td,"Neben")]//text()')
-        loader.add_value('date_scraped', date.today())
-        loader.add_value('date_last_seen', date.today())
-        loader.add_value('url', response.request.url.split('?')[0])
-
-        immo_item = loader.load_item()
-
-        yield immo_item
+        record = cls.loader.load(cls.extractor.extract(response), date_scraped=date.today(),
+                                 date_last_seen=date.today(), url=response.request.url.split('?')[0])
+        return record.item()
+
+    def closed(self, reason):
+        """
+        The URLs that were seen since the last update are written to the database when the spider is closed.
+
+        Parameters:
+            reason (str): reason why the spider was closed
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when all updates have finished
+        """
+        return self.seen_urls.flush()
@@ -1,8 +1,8 @@
 import scrapy
-import psycopg2
+from scrapy import signals
 from datetime import date, timedelta
-from immo_crawl.items import PriceCheckItem, PriceCheckLoader
-from immo_crawl.credentials import HOSTNAME, USERNAME, PASSWORD, DATABASE
+from immo_crawl.items import PriceCheckItem, PriceCheckLoader, CompiledLoader
+from immo_crawl.scheduling import PriceCheckScheduler
 
 
 class PricecheckSpider(scrapy.Spider):
@@ -13,6 +13,9 @@ class PricecheckSpider(scrapy.Spider):
     Attributes:
         name (str): name of the spider
         custom_settings (dict): special settings for this spider
+        fingerprint_xpath (str): XPath of the content whose change is detected by 
+            :class:`~immo_crawl.middlewares.ConditionalRequestMiddleware`
+        loader (:class:`~immo_crawl.items.CompiledLoader`): input processors of :class:`~immo_crawl.items.PriceCheckLoader`
     """
     name = 'pricecheck'
     custom_settings = {
@@ -20,31 +23,51 @@ class PricecheckSpider(scrapy.Spider):
             'immo_crawl.pipelines.PriceCheckValidation': 100,
             'immo_crawl.pipelines.ComparePrice': 150,
             'immo_crawl.pipelines.WritePrice': 200
-        }}
+        },
+        'DOWNLOADER_MIDDLEWARES': {
+            'immo_crawl.middlewares.AdaptiveConcurrencyMiddleware': 900,
+            'immo_crawl.middlewares.ConditionalRequestMiddleware': 580,
+        },
+        'CONDITIONAL_CACHE_PATH': 'httpcache/pricecheck.sqlite',
+    }
+    fingerprint_xpath = '//article[1]/div/h2/text()'
+    loader = CompiledLoader(PriceCheckLoader, PriceCheckItem)
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        return spider
+
+    def spider_opened(self, spider):
+        """
+        Reads the active URLs in the database and selects the ads whose price has probably 
+        changed (cf. :class:`~immo_crawl.scheduling.PriceCheckScheduler`), before the first 
+        request is sent and without blocking the crawl.
+
+        Returns:
+            twisted.internet.defer.Deferred: fires when the ads have been selected
+        """
+        self.scheduler = PriceCheckScheduler.from_spider(self)
+        return self.scheduler.load(date.today() - timedelta(days=7))
 
     def start_requests(self):
         """
-        Read the active URLs in the database for which requests are sent to the server. 
-        The resulting responses are processed using :meth:`parse`.
+        Sends requests for the ads selected when the spider was opened, the most likely 
+        changed first. The resulting responses are processed using :meth:`parse`.
 
         Yields:
             :class:`scrapy:scrapy.http.Request`: HTTP request that is processed with :meth:`parse`
         """
-        check_date = date.today() - timedelta(days=7)
-        conn = psycopg2.connect(
-            host=HOSTNAME, user=USERNAME, password=PASSWORD, dbname=DATABASE)
-        with conn.cursor() as cur:
-            cur.execute(
-                'SELECT url FROM eva_data WHERE date_last_seen > %s;', (check_date, ))
-            pricecheck_urls = [url[0] for url in cur.fetchall()]
-        conn.close()
-
-        for url in pricecheck_urls:
-            yield scrapy.Request(url, callback=self.parse)
+        for url, probability in self.scheduler.schedule():
+            yield scrapy.Request(url, callback=self.parse, priority=self.scheduler.priority(probability),
+                                 meta={'change_probability': probability})
 
     def parse(self, response, **kwargs):
         """
-        The prices are scraped from the ads and written to a :attr:`price_item` by a :attr:`loader`.
+        The prices are scraped from the ads and written to a :attr:`price_item` by the compiled :attr:`loader`. 
+        Ads whose price did not change since the last run are not passed to this method 
+        (cf. :class:`~immo_crawl.middlewares.ConditionalRequestMiddleware`).
 
         Parameters:
             response (scrapy.http.Response): HTTP response to a sent request
@@ -54,14 +77,16 @@ class PricecheckSpider(scrapy.Spider):
             (cf. :attr:`custom_settings`)
 
         Attributes:
-            loader (:class:`~immo_crawl.items.PriceCheckLoader`):  object to collect data from HTML write to :attr:`price_item`
             price_item (:class:`~immo_crawl.items.PriceCheckItem`): container for storing the data to be written to the database
         """
-        loader = PriceCheckLoader(item=PriceCheckItem(), response=response)
-        loader.add_value('url', response.request.url.split('?')[0])
-        loader.add_value('date', date.today())
-        loader.add_xpath('price_chf', '//article[1]/div/h2/text()')
-
-        price_item = loader.load_item()
+        record = self.loader.load(url=response.request.url.split('?')[0], date=date.today(),
+                                  price_chf=response.xpath(self.fingerprint_xpath).getall())
+        price_item = record.item()
 
         yield price_item
+
+    def closed(self, reason):
+        """
+        Reports the expected and observed price changes and stores the date of the checks.
+        """
+        return self.scheduler.close()
@@ -0,0 +1,114 @@
+"""
+AIMD control of the concurrency and the download delay of a domain, applied to the download
+slots by :class:`~immo_crawl.middlewares.AdaptiveConcurrencyMiddleware`.
+
+While the responses of a domain are fast and successful, the rate is increased additively
+once per round, i.e. when as many responses have arrived as requests are in parallel, but at
+least one second of requests: the delay is shortened so that one step more requests per second
+are sent, and once the minimum delay is reached, one more request is sent in parallel. When a
+response is throttled (429, 503), fails or is slower than the target latency, the rate is
+decreased multiplicatively: the concurrency is multiplied and the delay divided by the backoff
+factor, and the delay is at least as long as the server asked for (``Retry-After``). Responses
+to requests that were sent before the last decrease do not decrease the rate again, since
+their signal is already accounted for.
+"""
+import time
+
+# Statuses by which a server asks to slow down
+THROTTLE_STATUSES = {429, 503}
+
+
+class DomainController(object):
+    """
+    Concurrency and download delay of one domain within its politeness limits.
+
+    Attributes:
+        min_concurrency (int): lowest number of requests in parallel
+        max_concurrency (int): highest number of requests in parallel
+        min_delay (float): shortest delay between two requests in seconds
+        max_delay (float): longest delay between two requests in seconds
+        rate_step (float): requests per second added per increase
+        target_latency (float): download latency in seconds above which the rate is decreased
+        backoff (float): factor by which the rate is decreased
+        smoothing (float): weight of the last response in the averages
+        concurrency (int): current number of requests in parallel
+        delay (float): current delay between two requests
+        latency (float): moving average of the download latency
+        error_rate (float): moving average of the share of failed responses
+        throttle_rate (float): moving average of the share of throttled responses
+        successes (int): successful responses since the last change
+        decreased_at (float): time of the last decrease (:func:`time.monotonic`)
+    """
+
+    def __init__(self, concurrency, delay, min_concurrency=1, max_concurrency=4, min_delay=0.25,
+                 max_delay=60.0, rate_step=0.25, target_latency=2.0, backoff=0.5, smoothing=0.2):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(max_concurrency, min_concurrency)
+        self.min_delay = min_delay
+        self.max_delay = max(max_delay, min_delay)
+        self.rate_step = rate_step
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.concurrency = min(max(concurrency, self.min_concurrency), self.max_concurrency)
+        self.delay = min(max(delay, self.min_delay), self.max_delay)
+        self.latency = None
+        self.error_rate = 0.0
+        self.throttle_rate = 0.0
+        self.successes = 0
+        self.decreased_at = float('-inf')
+
+    def average(self, mean, value):
+        return mean + self.smoothing * (value - mean)
+
+    def response(self, sent_at, latency=None, throttled=False, error=False, retry_after=None):
+        """
+        Records a response (or a failed download) and adjusts the rate.
+
+        Parameters:
+            sent_at (float): time at which the request was sent (:func:`time.monotonic`)
+            latency (float): download latency in seconds, ``None`` if the download failed
+            throttled (bool): whether the server asked to slow down
+            error (bool): whether the download failed or the server returned an error
+            retry_after (float): seconds the server asked to wait (``Retry-After``)
+
+        Returns:
+            str: ``'increase'`` or ``'decrease'`` if the rate was changed, else ``None``
+        """
+        if latency is not None:
+            self.latency = latency if self.latency is None else self.average(self.latency, latency)
+        self.error_rate = self.average(self.error_rate, float(error))
+        self.throttle_rate = self.average(self.throttle_rate, float(throttled))
+
+        slow = latency is not None and latency > self.target_latency and self.latency > self.target_latency
+        if throttled or error or slow:
+            if sent_at < self.decreased_at:
+                return None
+            return self.decrease(retry_after)
+
+        self.successes += 1
+        if self.successes < max(self.concurrency, 1.0 / self.delay if self.delay else 0):
+            return None
+        return self.increase()
+
+    def increase(self):
+        self.successes = 0
+        if self.delay > self.min_delay:
+            self.delay = max(1.0 / (1.0 / self.delay + self.rate_step), self.min_delay)
+        elif self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+        else:
+            return None
+        return 'increase'
+
+    def decrease(self, retry_after=None):
+        self.successes = 0
+        self.decreased_at = time.monotonic()
+        if self.delay or self.concurrency > self.min_concurrency:
+            delay = self.delay / self.backoff
+        else:
+            # One request at a time without delay: the rate is reduced by waiting in proportion to the latency
+            delay = (self.latency or 1.0) * (1.0 / self.backoff - 1.0)
+        self.concurrency = max(int(self.concurrency * self.backoff), self.min_concurrency)
+        self.delay = min(max(delay, self.min_delay, retry_after or 0.0), self.max_delay)
+        return 'decrease'
@@ -0,0 +1,108 @@
+from hashlib import blake2b
+from twisted.internet import defer
+
+
+def normalize_url(url):
+    """
+    Removes the fragment and a trailing slash from a URL, so that different
+    spellings of the same advertisement URL result in the same key.
+    """
+    return url.split('#')[0].rstrip('/')
+
+
+def url_key(url):
+    """
+    Returns a 64-bit hash of the normalized URL.
+    """
+    digest = blake2b(normalize_url(url).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class VisitedUrlIndex(object):
+    """
+    Set of the URLs that have already been scraped. Only a 64-bit hash of each URL
+    is kept, so that membership tests take constant time and the index needs far less
+    memory than a list of the URL strings.
+
+    Attributes:
+        keys (set): hashes of the visited URLs
+    """
+
+    def __init__(self, urls=()):
+        self.keys = {url_key(url) for url in urls}
+
+    def __contains__(self, url):
+        return url_key(url) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, url):
+        """
+        Marks a URL as visited.
+
+        Parameters:
+            url (str): URL of the advertisement
+        """
+        self.keys.add(url_key(url))
+
+
+def load_visited_urls(conn, itersize=10000):
+    """
+    Builds the index of all URLs in ``eva_data``, fetched in batches from a server-side cursor.
+
+    Parameters:
+        conn (psycopg2.extensions.connection): connection to the database
+        itersize (int): number of rows fetched at once
+
+    Returns:
+        VisitedUrlIndex: the index
+    """
+    with conn.cursor(name='load_visited_urls') as cur:
+        cur.itersize = itersize
+        cur.execute('SELECT url FROM eva_data;')
+        return VisitedUrlIndex(url for url, in cur)
+
+
+class VisitedUrlLoader(object):
+    """
+    Loads the :class:`VisitedUrlIndex` in a thread of the connection pool, so that the spider
+    sends its first requests while the index is loaded. The callbacks that need the index wait
+    for it with :meth:`wait`.
+
+    Attributes:
+        index (VisitedUrlIndex): the loaded index, ``None`` while it is loaded
+        failure (twisted.python.failure.Failure): the error if the index could not be loaded
+    """
+
+    def __init__(self, pool):
+        self.index = None
+        self.failure = None
+        self.waiters = []
+        d = pool.run('load_visited_urls', load_visited_urls, pool.itersize)
+        d.addCallbacks(self.loaded, self.failed)
+
+    def loaded(self, index):
+        self.index = index
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.callback(index)
+
+    def failed(self, failure):
+        self.failure = failure
+        waiters, self.waiters = self.waiters, []
+        for d in waiters:
+            d.errback(failure)
+
+    def wait(self):
+        """
+        Returns a Deferred that fires with the index as soon as it has been loaded. Each caller
+        gets its own Deferred, since the result of a Deferred is passed to one chain only.
+        """
+        if self.index is not None:
+            return defer.succeed(self.index)
+        if self.failure is not None:
+            return defer.fail(self.failure)
+        d = defer.Deferred()
+        self.waiters.append(d)
+        return d
@@ -5,6 +5,6 @@ from setuptools import setup, find_packages
 setup(
     name         = 'project',
     version      = '1.0',
-    packages     = find_packages(),
+    packages     = find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']),
     entry_points = {'scrapy': ['settings = immo_crawl.settings']},
 )
@@ -0,0 +1,131 @@
+"""
+Tests of :class:`~immo_crawl.middlewares.ConditionalRequestMiddleware` against the local HTTP
+stand-in of :mod:`benchmarks.server`, which sends an ``ETag`` with every page and answers a
+matching ``If-None-Match`` with 304.
+"""
+import queue
+import tempfile
+import threading
+import unittest
+import urllib.request
+from pathlib import Path
+from urllib.error import HTTPError
+
+import scrapy
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from benchmarks import server
+from immo_crawl.middlewares import ConditionalRequestMiddleware
+from immo_crawl.pipelines import InvalidItem
+from immo_crawl.spiders.pricecheck_spider import PricecheckSpider
+
+
+class DetailSpider(scrapy.Spider):
+    """
+    Spider with the fingerprint of the pricecheck, without its settings (cache path).
+    """
+    name = 'detail'
+    fingerprint_xpath = PricecheckSpider.fingerprint_xpath
+
+
+def start_server():
+    """
+    Starts the stand-in in a daemon thread and returns its base URL.
+    """
+    port_queue = queue.Queue()
+    threading.Thread(target=server.serve, args=(port_queue, ), daemon=True).start()
+    return 'http://127.0.0.1:{}'.format(port_queue.get(timeout=10))
+
+
+def fetch(request):
+    """
+    Sends the request with its headers to the stand-in and returns the response.
+    """
+    headers = {name.decode('latin-1'): values[0].decode('latin-1') for name, values in request.headers.items()}
+    try:
+        with urllib.request.urlopen(urllib.request.Request(request.url, headers=headers)) as response:
+            status, response_headers, body = response.status, response.headers, response.read()
+    except HTTPError as error:
+        status, response_headers, body = error.code, error.headers, error.read()
+    return HtmlResponse(request.url, status=status, headers=dict(response_headers.items()), body=body,
+                        request=request)
+
+
+class ConditionalRequestMiddlewareTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.base_url = start_server()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        crawler = get_crawler(DetailSpider, {
+            'CONDITIONAL_CACHE_PATH': str(Path(directory.name) / 'validators.sqlite')})
+        self.spider = DetailSpider.from_crawler(crawler)
+        self.stats = crawler.stats
+        self.middleware = ConditionalRequestMiddleware.from_crawler(crawler)
+        self.middleware.spider_opened(self.spider)
+        self.addCleanup(self.middleware.spider_closed, self.spider)
+        self.url = self.base_url + server.immoscout_detail_path(4711)
+
+    def download(self, url):
+        """
+        Passes a request through the middleware to the stand-in and back.
+        """
+        request = Request(url)
+        self.middleware.process_request(request, self.spider)
+        return self.middleware.process_response(request, fetch(request), self.spider)
+
+    def stat(self, name):
+        return self.stats.get_value('immo_crawl/conditional/' + name, 0)
+
+    def test_not_modified(self):
+        response = self.download(self.url)
+        self.assertEqual(response.status, 200)
+        self.middleware.item_scraped({}, response, self.spider)
+
+        request = Request(self.url)
+        self.middleware.process_request(request, self.spider)
+        self.assertEqual(request.headers.get('If-None-Match'), response.headers.get('ETag'))
+        with self.assertRaises(IgnoreRequest):
+            self.middleware.process_response(request, fetch(request), self.spider)
+        self.assertEqual(self.stat('not_modified'), 1)
+
+    def test_unchanged_content(self):
+        response = self.download(self.url)
+        etag, last_modified, fingerprint = response.meta['conditional_validators'][1:]
+        # Another ETag, e.g. after a change of the page that does not affect the price
+        self.middleware.cache.put(self.url, '"stale"', last_modified, fingerprint)
+
+        with self.assertRaises(IgnoreRequest):
+            self.download(self.url)
+        self.assertEqual(self.stat('unchanged'), 1)
+        self.assertEqual(self.middleware.cache.get(self.url)[0], etag)
+
+    def test_validators_stored_after_item(self):
+        response = self.download(self.url)
+        self.assertIsNone(self.middleware.cache.get(self.url))
+
+        # The item was not written, so the page is requested in full again
+        self.middleware.item_dropped({}, response, InvalidItem('missing_price'), self.spider)
+        self.assertEqual(self.download(self.url).status, 200)
+
+        response = self.download(self.url)
+        self.middleware.item_dropped({}, response, InvalidItem('price_unchanged'), self.spider)
+        self.assertIsNotNone(self.middleware.cache.get(self.url))
+        self.assertEqual(self.stat('changed'), 3)
+
+    def test_robots_txt(self):
+        url = self.base_url + '/robots.txt'
+        self.middleware.cache.put(url, '"robots"', None, None)
+
+        request = Request(url, meta={'dont_obey_robotstxt': True})
+        self.assertIsNone(self.middleware.process_request(request, self.spider))
+        self.assertNotIn('If-None-Match', request.headers)
+        response = fetch(request)
+        self.assertIs(self.middleware.process_response(request, response, self.spider), response)
+        not_modified = response.replace(status=304)
+        self.assertIs(self.middleware.process_response(request, not_modified, self.spider), not_modified)
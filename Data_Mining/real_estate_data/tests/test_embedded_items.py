@@ -0,0 +1,60 @@
+"""
+Tests of the items that the spiders build from the JSON state of a detail page
+(cf. :class:`~immo_crawl.extraction.EmbeddedJsonExtractor`) and their cleaning by
+:class:`~immo_crawl.pipelines.ValidateAndClean`.
+"""
+import json
+import unittest
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+
+from immo_crawl.pipelines import ValidateAndClean
+from immo_crawl.spiders.homegate_spider import HomegateSpider
+from immo_crawl.spiders.immoscout_spider import ImmoscoutSpider
+
+
+def state_response(url, state):
+    """
+    Returns a detail page that embeds the state as ``window.__INITIAL_STATE__``.
+    """
+    body = '<html><script>window.__INITIAL_STATE__ = {};</script></html>'.format(json.dumps(state))
+    return HtmlResponse(url, body=body.encode('utf-8'), encoding='utf-8', request=Request(url))
+
+
+class EmbeddedItemTest(unittest.TestCase):
+
+    def clean(self, spidercls, item):
+        spider = spidercls.from_crawler(get_crawler(spidercls))
+        return ValidateAndClean().process_item(item, spider)
+
+    def assert_written_fields(self, item):
+        for field in ('address', 'zip_code', 'city', 'canton', 'price_chf', 'rooms', 'area_m2', 'floor',
+                      'utilities_chf', 'date_available', 'date_scraped', 'date_last_seen', 'url'):
+            self.assertIn(field, item)
+
+    def test_homegate_without_street_and_city(self):
+        response = state_response('https://www.homegate.ch/mieten/3001', {'listing': {'listing': {
+            'address': {'postalCode': '8004'},
+            'characteristics': {'numberOfRooms': 3.5},
+            'prices': {'rent': {'gross': 2100}},
+        }}})
+        item = self.clean(HomegateSpider, HomegateSpider.build_item(response, 'ZH'))
+
+        self.assert_written_fields(item)
+        self.assertIsNone(item['address'])
+        self.assertIsNone(item['city'])
+        self.assertEqual(item['canton'], 'ZH')
+        self.assertEqual(item['zip_code'], '8004')
+        self.assertEqual(item['price_chf'], 2100)
+
+    def test_immoscout_without_street_city_and_canton(self):
+        response = state_response('https://www.immoscout24.ch/de/d/wohnung-mieten/4711?s=1', {'pages': {
+            'detail': {'propertyDetails': {'zip': '3011', 'numberOfRooms': 2, 'grossPrice': 1500}}}})
+        item = self.clean(ImmoscoutSpider, ImmoscoutSpider.build_item(response))
+
+        self.assert_written_fields(item)
+        self.assertIsNone(item['address'])
+        self.assertIsNone(item['city'])
+        self.assertIsNone(item['canton'])
+        self.assertEqual(item['url'], 'https://www.immoscout24.ch/de/d/wohnung-mieten/4711')
@@ -0,0 +1,119 @@
+"""
+Tests of :class:`~immo_crawl.middlewares.FrontierMiddleware` together with the buffer of
+:class:`~immo_crawl.pipelines.WriteToDB`: a run that is killed after the callback of a detail
+page but before the buffered item is written has to request the page again.
+"""
+import contextlib
+import tempfile
+import unittest
+from unittest import mock
+
+from scrapy import Spider, signals
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer
+
+from immo_crawl.frontier import CrawlFrontier
+from immo_crawl.middlewares import FrontierMiddleware
+from immo_crawl.pipelines import InvalidItem, WriteToDB
+
+
+class InstantPool(object):
+    """
+    Pool that runs the writes at once and stores the written URLs.
+    """
+
+    def __init__(self):
+        self.urls = []
+
+    def wait_for_capacity(self):
+        return defer.succeed(None)
+
+    def defer(self, func, *args):
+        return defer.maybeDeferred(func, *args)
+
+    @contextlib.contextmanager
+    def connection(self, operation='query'):
+        yield mock.MagicMock()
+
+    def execute_values(self, cur, query, rows, **kwargs):
+        self.urls.extend(row[12] for row in rows)
+        return [(row[12], True) for row in rows]
+
+
+class ListingSpider(Spider):
+    name = 'listing'
+
+    def parse(self, response):
+        yield Request('https://example.com/detail/1', callback=self.parse_item)
+
+    def parse_item(self, response):
+        yield {'url': response.url, 'price_chf': 1500}
+
+
+class FrontierMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.crawler = get_crawler(ListingSpider, {'FRONTIER_DIR': directory.name, 'FRONTIER_COMMIT_EVERY': 1})
+        self.spider = ListingSpider.from_crawler(self.crawler)
+        self.middleware = FrontierMiddleware.from_crawler(self.crawler)
+        self.middleware.spider_opened(self.spider)
+        self.addCleanup(self.middleware.frontier.close)
+
+        self.pool = InstantPool()
+        self.pipeline = WriteToDB(self.pool)
+        self.pipeline.open_spider(self.spider)
+        self.addCleanup(self.pipeline.flush_task.stop)
+        for name in ('execute_values', 'write_prices', 'update_current_prices'):
+            patcher = mock.patch('immo_crawl.pipelines.' + name, getattr(self.pool, name, mock.Mock()))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def process(self, request):
+        """
+        Passes the output of the callback through the middleware and its items through the pipeline.
+        """
+        response = HtmlResponse(request.url, body=b'<html></html>', request=request)
+        output = []
+        for i in self.middleware.process_spider_output(response, request.callback(response), self.spider):
+            if isinstance(i, dict):
+                self.pipeline.process_item(i, self.spider)
+                self.crawler.signals.send_catch_log(signals.item_scraped, item=i, response=response,
+                                                    spider=self.spider)
+            output.append(i)
+        return output
+
+    def pending(self):
+        """
+        Returns the pending URLs as a resumed run would read them.
+        """
+        frontier = CrawlFrontier(self.middleware.frontier.path)
+        try:
+            return [url for url, callback, cb_kwargs in frontier.pending()]
+        finally:
+            frontier.close()
+
+    def test_killed_before_flush(self):
+        start, = self.middleware.process_start_requests([Request('https://example.com/list')], self.spider)
+        detail, = self.process(start.replace(callback=self.spider.parse))
+        self.process(detail)
+
+        # The run is killed here: the item is still in the buffer of WriteToDB
+        self.assertEqual(self.pending(), ['https://example.com/detail/1'])
+
+        self.pipeline.flush(self.spider)
+        self.assertEqual(self.pool.urls, ['https://example.com/detail/1'])
+        self.assertEqual(self.pending(), [])
+
+    def test_dropped_item(self):
+        request = Request('https://example.com/detail/2', callback=self.spider.parse_item)
+        self.middleware.add(request)
+        response = HtmlResponse(request.url, body=b'', request=request)
+        item, = self.middleware.process_spider_output(response, request.callback(response), self.spider)
+        self.assertEqual(self.pending(), ['https://example.com/detail/2'])
+
+        self.crawler.signals.send_catch_log(signals.item_dropped, item=item, response=response,
+                                            exception=InvalidItem('missing_price'), spider=self.spider)
+        self.assertEqual(self.pending(), [])
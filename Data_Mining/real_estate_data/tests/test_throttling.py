@@ -0,0 +1,49 @@
+"""
+Tests of the AIMD policy of :class:`~immo_crawl.throttling.DomainController`.
+"""
+import time
+import unittest
+
+from immo_crawl.throttling import DomainController
+
+
+class DomainControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = DomainController(2, 1.0, min_concurrency=1, max_concurrency=2, min_delay=1.0,
+                                           max_delay=60.0, target_latency=2.0, backoff=0.5)
+
+    def test_throttled_backs_off(self):
+        decision = self.controller.response(time.monotonic(), latency=0.1, throttled=True, retry_after=5.0)
+        self.assertEqual(decision, 'decrease')
+        self.assertEqual(self.controller.concurrency, 1)
+        self.assertGreaterEqual(self.controller.delay, 5.0)
+
+    def test_throttled_without_retry_after(self):
+        self.controller.response(time.monotonic(), latency=0.1, throttled=True)
+        self.assertEqual(self.controller.delay, 2.0)
+
+    def test_slow_response_decreases(self):
+        decision = self.controller.response(time.monotonic(), latency=3.0)
+        self.assertEqual(decision, 'decrease')
+        self.assertEqual(self.controller.concurrency, 1)
+        self.assertEqual(self.controller.delay, 2.0)
+
+    def test_responses_sent_before_decrease_are_ignored(self):
+        sent_at = time.monotonic()
+        self.controller.response(sent_at, throttled=True)
+        self.assertIsNone(self.controller.response(sent_at, throttled=True))
+        self.assertEqual(self.controller.delay, 2.0)
+
+    def test_fast_responses_stay_within_limits(self):
+        for _ in range(20):
+            self.controller.response(time.monotonic(), latency=0.1)
+        self.assertEqual(self.controller.concurrency, 2)
+        self.assertEqual(self.controller.delay, 1.0)
+
+    def test_recovers_after_decrease(self):
+        self.controller.response(time.monotonic(), latency=0.1, throttled=True)
+        for _ in range(20):
+            self.controller.response(time.monotonic(), latency=0.1)
+        self.assertEqual(self.controller.delay, 1.0)
+        self.assertEqual(self.controller.concurrency, 2)
@@ -0,0 +1,80 @@
+"""
+Tests of the error handling of :class:`~immo_crawl.pipelines.WriteToDB`, with a stand-in of
+the connection pool that fails like the database would.
+"""
+import contextlib
+import unittest
+from unittest import mock
+
+import psycopg2
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+from twisted.python.failure import Failure
+
+from immo_crawl.pipelines import WriteToDB
+
+
+class FailingPool(object):
+    """
+    Pool whose connections fail with ``error``, or whose writes fail for the URLs in ``faulty_urls``.
+    """
+
+    def __init__(self, error=None, faulty_urls=()):
+        self.error = error
+        self.faulty_urls = set(faulty_urls)
+        self.connections = 0
+
+    @contextlib.contextmanager
+    def connection(self, operation='query'):
+        self.connections += 1
+        if self.error is not None:
+            raise self.error
+        yield mock.MagicMock()
+
+    def execute_values(self, cur, query, rows, **kwargs):
+        if self.faulty_urls.intersection(row[12] for row in rows):
+            raise TypeError('not a number')
+        return [(row[12], True) for row in rows]
+
+
+class WriteToDBTest(unittest.TestCase):
+
+    def setUp(self):
+        crawler = get_crawler(Spider)
+        self.spider = Spider.from_crawler(crawler, name='test')
+        self.stats = crawler.stats
+        self.items = [{'url': 'https://example.com/{}'.format(i), 'price_chf': 1000 + i} for i in range(8)]
+
+    def write(self, pool):
+        pipeline = WriteToDB(pool)
+        with mock.patch('immo_crawl.pipelines.execute_values', pool.execute_values), \
+                mock.patch('immo_crawl.pipelines.write_prices'), \
+                mock.patch('immo_crawl.pipelines.update_current_prices'):
+            return pipeline, pipeline.write_batch(self.items)
+
+    def test_faulty_item_is_skipped(self):
+        pipeline, (written, failed) = self.write(FailingPool(faulty_urls=['https://example.com/3']))
+        self.assertEqual(len(written), 7)
+        self.assertEqual([item['url'] for item, error in failed], ['https://example.com/3'])
+
+        pipeline.batch_written((written, failed), self.spider)
+        self.assertEqual(self.stats.get_value('immo_crawl/db/written_items'), 7)
+        self.assertEqual(self.stats.get_value('immo_crawl/db/failed_items'), 1)
+
+    def test_unreachable_database_keeps_batch(self):
+        pool = FailingPool(error=psycopg2.OperationalError('connection refused'))
+        with self.assertRaises(psycopg2.OperationalError):
+            self.write(pool)
+        self.assertEqual(pool.connections, 1)
+
+        pipeline = WriteToDB(pool)
+        pipeline.buffer = [{'url': 'https://example.com/new'}]
+        pipeline.batch_failed(Failure(psycopg2.OperationalError('connection refused')), self.items, self.spider)
+        self.assertTrue(pipeline.unavailable)
+        self.assertEqual(len(pipeline.buffer), 9)
+        self.assertIsNone(self.stats.get_value('immo_crawl/db/failed_items'))
+
+        # When the spider is closed, the batch is not kept any more
+        pipeline.closing = True
+        pipeline.batch_failed(Failure(psycopg2.OperationalError('connection refused')), self.items, self.spider)
+        self.assertEqual(self.stats.get_value('immo_crawl/db/failed_items'), 8)